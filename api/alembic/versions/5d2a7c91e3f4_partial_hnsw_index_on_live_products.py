@@ -0,0 +1,58 @@
+"""partial HNSW index on live, embedded products
+
+Revision ID: 5d2a7c91e3f4
+Revises: bc5ec16e83f4
+Create Date: 2026-10-18 10:02:11.418203
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d2a7c91e3f4"
+down_revision: Union[str, None] = "bc5ec16e83f4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY can't run in a transaction, but keeps the table writable
+    # and the old index serving searches while the new one builds
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_embedding_live_hnsw_idx
+            ON products
+            USING hnsw (embedding vector_cosine_ops)
+            WITH (m = 16, ef_construction = 1000)
+            WHERE embedding IS NOT NULL AND "deletedAt" IS NULL;
+        """
+        )
+        op.execute(
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS products_embedding_hnsw_idx;
+        """
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_embedding_hnsw_idx
+            ON products
+            USING hnsw (embedding vector_cosine_ops)
+            WITH (m = 16, ef_construction = 1000);
+        """
+        )
+        op.execute(
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS products_embedding_live_hnsw_idx;
+        """
+        )
@@ -0,0 +1,44 @@
+"""add trigram index on title
+
+Revision ID: 8e41b6f0c2d7
+Revises: 5d2a7c91e3f4
+Create Date: 2026-10-18 10:41:37.902615
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8e41b6f0c2d7"
+down_revision: Union[str, None] = "5d2a7c91e3f4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_title_trgm_idx
+            ON products
+            USING gin (title gin_trgm_ops)
+            WHERE "deletedAt" IS NULL;
+        """
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS products_title_trgm_idx;
+        """
+        )
+    op.execute("DROP EXTENSION IF EXISTS pg_trgm;")
@@ -0,0 +1,31 @@
+"""add quality score rules column
+
+Revision ID: a7d2e9c4b1f6
+Revises: f1b7c4e2a9d8
+Create Date: 2026-10-18 17:42:13.518204
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a7d2e9c4b1f6"
+down_revision: Union[str, None] = "f1b7c4e2a9d8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing scores don't record their rules, so search recomputes them live
+    # until python -m app.scripts.backfill_quality_score --stale-only runs
+    op.add_column("products", sa.Column("quality_score_rules", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("products", "quality_score_rules")
@@ -0,0 +1,44 @@
+"""add trigram gist index on title
+
+Revision ID: b4e8c1f7d3a2
+Revises: a7d2e9c4b1f6
+Create Date: 2026-10-18 18:27:51.604319
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b4e8c1f7d3a2"
+down_revision: Union[str, None] = "a7d2e9c4b1f6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Serves ORDER BY title <->> :keywords as a KNN scan; the GIN index stays
+    # for selective ILIKE filters
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_title_trgm_gist_idx
+            ON products
+            USING gist (title gist_trgm_ops)
+            WHERE "deletedAt" IS NULL;
+        """
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute(
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS products_title_trgm_gist_idx;
+        """
+        )
@@ -0,0 +1,31 @@
+"""add quality score column
+
+Revision ID: c3f9a0d5b7e2
+Revises: 8e41b6f0c2d7
+Create Date: 2026-10-18 14:02:11.318204
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c3f9a0d5b7e2"
+down_revision: Union[str, None] = "8e41b6f0c2d7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable without a default, so this doesn't rewrite the table. Fill it
+    # with python -m app.scripts.backfill_quality_score
+    op.add_column("products", sa.Column("quality_score", sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("products", "quality_score")
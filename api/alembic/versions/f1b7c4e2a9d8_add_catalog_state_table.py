@@ -0,0 +1,42 @@
+"""add catalog state table
+
+Revision ID: f1b7c4e2a9d8
+Revises: c3f9a0d5b7e2
+Create Date: 2026-10-18 16:27:45.102938
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f1b7c4e2a9d8"
+down_revision: Union[str, None] = "c3f9a0d5b7e2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "catalog_state",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("version", sa.BigInteger(), server_default="0", nullable=False),
+        sa.Column(
+            "modifiedAt",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    # The single row the catalog writers bump
+    op.execute("INSERT INTO catalog_state (id, version) VALUES (1, 0)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("catalog_state")
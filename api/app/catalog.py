@@ -0,0 +1,47 @@
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# How stale a worker's view of the catalog version may be. Searches cached
+# under an old version are served for at most this long after a write.
+CATALOG_VERSION_POLL_SECONDS = float(os.getenv("CATALOG_VERSION_POLL_SECONDS", "5"))
+
+select_catalog_version = text("SELECT version FROM catalog_state WHERE id = 1")
+bump_catalog_version_query = text(
+    'UPDATE catalog_state SET version = version + 1, "modifiedAt" = now() WHERE id = 1'
+)
+
+
+def bump_catalog_version(db):
+    """Marks the catalog as changed. Run in the same transaction as the write."""
+    db.execute(bump_catalog_version_query)
+
+
+class CatalogVersion:
+    """The catalog version, re-read from Postgres at most every poll_seconds."""
+
+    def __init__(self, poll_seconds: float = CATALOG_VERSION_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.version = None
+        self._checked_at = 0.0
+
+    async def current(self, db):
+        """The cached version, or None if it can't be read (caches are then skipped)."""
+        if time.monotonic() - self._checked_at < self.poll_seconds:
+            return self.version
+        # Set first, so concurrent searches don't all poll
+        self._checked_at = time.monotonic()
+        try:
+            self.version = (await db.execute(select_catalog_version)).scalar()
+        except Exception:
+            logger.exception("Could not read the catalog version")
+            await db.rollback()
+            self.version = None
+        return self.version
+
+
+catalog_version = CatalogVersion()
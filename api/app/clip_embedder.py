@@ -2,14 +2,55 @@
 # clip_processor = CLIPProcessor.from_pretrained("patrickjohncyh/fashion-clip")
 
 
-from transformers import CLIPModel, CLIPProcessor
-import torch
+import asyncio
+import fcntl
+import logging
+import numpy as np
+import os
+import tempfile
+import threading
+
+from app.cache import TTLCache
+from app.embedding_batcher import EmbeddingBatcher
+
+logger = logging.getLogger(__name__)
 
 
 # model = SentenceTransformer("all-MiniLM-L6-v2")
 
-clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+MODEL_NAME = "openai/clip-vit-base-patch32"
+
+# "torch" (eager fp32), "onnx" (ONNX Runtime fp32) or "onnx-int8" (dynamically
+# quantized). Check ONNX backends with app.scripts.embedding_parity first.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Per-process CPU budget for the encoder. With several uvicorn workers on one
+# box keep workers x intra-op threads <= cores, otherwise workers oversubscribe
+# each other. 0 keeps the library default (all cores). Pick values per machine
+# with app.scripts.benchmark_embeddings.
+EMBEDDING_INTRA_OP_THREADS = int(os.getenv("EMBEDDING_INTRA_OP_THREADS", "0"))
+EMBEDDING_INTER_OP_THREADS = int(os.getenv("EMBEDDING_INTER_OP_THREADS", "0"))
+# CPUs to pin this process to, e.g. "0-3,8", or "auto" to give each worker on
+# the box its own slice of EMBEDDING_INTRA_OP_THREADS cores
+EMBEDDING_CPU_AFFINITY = os.getenv("EMBEDDING_CPU_AFFINITY", "")
+
+# Loaded on first use (or by warm_up on server startup) so importing this
+# module doesn't pay for torch and the model weights
+text_encoder = None
+_model_lock = threading.Lock()
+
+# Backends don't produce bit-identical vectors, so they get separate entries
+EMBEDDING_CACHE_KEY = f"{MODEL_NAME}:{EMBEDDING_BACKEND}"
+
+# (model and backend, exact input text) -> float32 embedding, about 2 KB per entry
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+embedding_cache = TTLCache(maxsize=EMBEDDING_CACHE_SIZE)
+
+# Concurrent single-query embeds are coalesced into one forward pass
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "true").lower() == "true"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
 
 
 # def embed_text(text: str) -> list[float]:
@@ -25,13 +66,252 @@ clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
 def embed_text(texts: list[str]) -> list[list[float]]:
     """Returns normalized embeddings for a list of input texts."""
-    with torch.no_grad():
-        inputs = clip_processor(
-            text=texts, return_tensors="pt", padding=True, truncation=True
+    embeddings = [embedding_cache.get((EMBEDDING_CACHE_KEY, text)) for text in texts]
+
+    missing_texts = [text for text, e in zip(texts, embeddings) if e is None]
+    if missing_texts:
+        computed = iter(_encode_and_cache(missing_texts))
+        embeddings = [next(computed) if e is None else e for e in embeddings]
+
+    return [embedding.tolist() for embedding in embeddings]
+
+
+async def embed_query_async(text: str) -> list[float]:
+    """Returns the normalized embedding for one text, batched with concurrent callers."""
+    embedding = embedding_cache.get((EMBEDDING_CACHE_KEY, text))
+    if embedding is None:
+        if EMBEDDING_BATCHING:
+            # Shielded: a cancelled search (e.g. the speculative probe) must not
+            # cancel the batcher's future, the batch still finishes and is cached
+            embedding = await asyncio.shield(
+                asyncio.wrap_future(embedding_batcher.submit(text))
+            )
+        else:
+            embedding = (await asyncio.to_thread(_encode_and_cache, [text]))[0]
+    return embedding.tolist()
+
+
+class TorchTextEncoder:
+    """CLIP text tower in eager PyTorch."""
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        from transformers import CLIPModel, CLIPProcessor
+
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.model = CLIPModel.from_pretrained(model_name)
+        self.model.eval()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            inputs = self.processor(
+                text=texts, return_tensors="pt", padding=True, truncation=True
+            )
+            text_features = self.model.get_text_features(**inputs)
+            embeddings = text_features / text_features.norm(dim=-1, keepdim=True)
+            return embeddings.numpy().astype(np.float32)
+
+
+def create_text_encoder(
+    backend: str = EMBEDDING_BACKEND,
+    intra_op_threads: int = EMBEDDING_INTRA_OP_THREADS,
+    inter_op_threads: int = EMBEDDING_INTER_OP_THREADS,
+):
+    if backend == "torch":
+        return TorchTextEncoder()
+    if backend in ("onnx", "onnx-int8"):
+        from app.onnx_embedder import ONNXTextEncoder
+
+        return ONNXTextEncoder(
+            quantized=backend == "onnx-int8",
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
         )
-        text_features = clip_model.get_text_features(**inputs)
-        embeddings = text_features / text_features.norm(dim=-1, keepdim=True)
-        return embeddings.tolist()
+    raise ValueError(
+        f"Unknown EMBEDDING_BACKEND {backend!r}, expected one of {EMBEDDING_BACKENDS}"
+    )
+
+
+def parse_cpu_list(value: str) -> list[int]:
+    """Parses a Linux style CPU list like "0-3,8" into [0, 1, 2, 3, 8]."""
+    cpus = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+# Lock files of claimed CPU slots, kept open for the life of the process
+_held_locks = []
+
+
+def claim_worker_cpus(cpus_per_worker: int) -> list[int]:
+    """Claims the first free slice of cpus_per_worker CPUs among the workers on this box.
+
+    Slots are held with an exclusive lock on a per-slot file for the life of the
+    process, so restarted workers reuse the slices of the ones that exited.
+    """
+    available = sorted(os.sched_getaffinity(0))
+    slots = max(len(available) // cpus_per_worker, 1)
+    for slot in range(slots):
+        path = os.path.join(tempfile.gettempdir(), f"clip-embedder-cpu-slot-{slot}.lock")
+        lock_file = open(path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _held_locks.append(lock_file)
+        return available[slot * cpus_per_worker : (slot + 1) * cpus_per_worker]
+    # More workers than slices, share all CPUs
+    return available
+
+
+def pin_process(
+    intra_op_threads: int = EMBEDDING_INTRA_OP_THREADS,
+    inter_op_threads: int = EMBEDDING_INTER_OP_THREADS,
+    cpu_affinity: str = EMBEDDING_CPU_AFFINITY,
+) -> dict:
+    """Pins the calling thread to its CPUs and caps OpenMP threads for the process.
+
+    On Linux affinity is per thread and inherited by threads created later, so
+    call this on the main thread before any other threads start. The OpenMP
+    variables only take effect if torch hasn't been imported yet.
+    """
+    cpus = None
+    if cpu_affinity == "auto" and intra_op_threads > 0:
+        cpus = claim_worker_cpus(intra_op_threads)
+    elif cpu_affinity and cpu_affinity != "auto":
+        cpus = parse_cpu_list(cpu_affinity)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        if intra_op_threads <= 0:
+            intra_op_threads = len(cpus)
+
+    if intra_op_threads > 0:
+        # Read by every OpenMP team, including the batcher thread's
+        os.environ.setdefault("OMP_NUM_THREADS", str(intra_op_threads))
+        os.environ.setdefault("MKL_NUM_THREADS", str(intra_op_threads))
+
+    return {
+        "cpus": cpus,
+        "intra_op_threads": intra_op_threads,
+        "inter_op_threads": inter_op_threads,
+    }
+
+
+def configure_torch_threads(settings: dict):
+    import torch
+
+    if settings["intra_op_threads"] > 0:
+        torch.set_num_threads(settings["intra_op_threads"])
+    if settings["inter_op_threads"] > 0:
+        try:
+            torch.set_num_interop_threads(settings["inter_op_threads"])
+        except RuntimeError as e:
+            # Can only be set before torch runs any inter-op parallel work
+            logger.warning("Could not set inter-op threads: %s", e)
+
+
+def configure_threads(
+    backend: str = EMBEDDING_BACKEND,
+    intra_op_threads: int = EMBEDDING_INTRA_OP_THREADS,
+    inter_op_threads: int = EMBEDDING_INTER_OP_THREADS,
+    cpu_affinity: str = EMBEDDING_CPU_AFFINITY,
+) -> dict:
+    """Pins this process to its CPUs and sizes torch's thread pools.
+
+    Returns the resolved settings; ONNX backends take the thread counts when
+    their session is created.
+    """
+    settings = pin_process(intra_op_threads, inter_op_threads, cpu_affinity)
+    if backend == "torch":
+        configure_torch_threads(settings)
+    return settings
+
+
+# Resolved once per process by configure_process_threads
+thread_settings = None
+_thread_settings_lock = threading.Lock()
+
+
+def configure_process_threads() -> dict:
+    """Applies the configured CPU affinity once per process, see pin_process.
+
+    The server calls this on the main thread at startup; later calls (e.g.
+    from load_model in scripts) return the same settings.
+    """
+    global thread_settings
+    with _thread_settings_lock:
+        if thread_settings is None:
+            if threading.current_thread() is not threading.main_thread():
+                logger.warning(
+                    "Embedding CPU affinity set off the main thread, other threads stay unpinned"
+                )
+            thread_settings = pin_process()
+            logger.info("Embedding thread settings %s", thread_settings)
+    return thread_settings
+
+
+def load_model():
+    """Loads the configured text encoder once per process."""
+    global text_encoder
+    if text_encoder is None:
+        with _model_lock:
+            if text_encoder is None:
+                settings = configure_process_threads()
+                if EMBEDDING_BACKEND == "torch":
+                    configure_torch_threads(settings)
+                text_encoder = create_text_encoder(
+                    intra_op_threads=settings["intra_op_threads"],
+                    inter_op_threads=settings["inter_op_threads"],
+                )
+    return text_encoder
+
+
+def is_model_loaded() -> bool:
+    return text_encoder is not None
+
+
+def warm_up():
+    """Loads the model and runs one forward pass so the first request is fast."""
+    load_model()
+    _encode(["warm up"])
+
+
+def embedding_cache_stats() -> dict:
+    return embedding_cache.stats()
+
+
+def embedding_batcher_stats() -> dict:
+    return embedding_batcher.stats()
+
+
+def _encode_and_cache(texts: list[str]) -> list[np.ndarray]:
+    # Only run the model once per distinct text
+    unique_texts = list(dict.fromkeys(texts))
+    computed = dict(zip(unique_texts, _encode(unique_texts)))
+    for text, embedding in computed.items():
+        embedding_cache.set((EMBEDDING_CACHE_KEY, text), embedding)
+    return [computed[text] for text in texts]
+
+
+def _encode(texts: list[str]) -> np.ndarray:
+    return load_model().encode(texts)
+
+
+embedding_batcher = EmbeddingBatcher(
+    _encode_and_cache,
+    max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+    max_wait_ms=EMBEDDING_BATCH_MAX_WAIT_MS,
+)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent single-text embedding calls into batched model calls.
+
+    Callers block on their own row while a background thread collects texts for
+    up to max_wait_ms (or max_batch_size texts) and embeds them in one forward pass.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[list], Sequence],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+    ):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.texts = 0
+        # Texts whose caller gave up before their batch started
+        self.cancelled = 0
+        self.restarts = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = Counter()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def embed(self, text: str):
+        return self.submit(text).result()
+
+    def submit(self, text: str) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "cancelled": self.cancelled,
+            "restarts": self.restarts,
+            "mean_batch_size": self.texts / self.batches if self.batches else 0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+    def _ensure_started(self):
+        # Also restarts the thread if it ever died, so embedding can't stall for good
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is not None:
+                        logger.error("Embedding batcher thread died, restarting it")
+                        self.restarts += 1
+                    self._thread = threading.Thread(
+                        target=self._run, name="embedding-batcher", daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._run_batch()
+            except Exception:
+                logger.exception("Error in embedding batcher")
+
+    def _run_batch(self):
+        batch = [self._queue.get()]
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize() + 1)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Marks the rest running, so a late cancel can't race the results below
+        live = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        self.cancelled += len(batch) - len(live)
+        if not live:
+            return
+
+        self.batches += 1
+        self.texts += len(live)
+        self.batch_sizes[len(live)] += 1
+
+        try:
+            embeddings = self.embed_fn([text for text, _ in live])
+            for (_, future), embedding in zip(live, embeddings):
+                future.set_result(embedding)
+        except Exception as e:
+            for _, future in live:
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,270 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Only accept local parses at or above this confidence, the rest go to the LLM
+LOCAL_PARSE_ENABLED = os.getenv("LOCAL_PARSE_ENABLED", "true").lower() == "true"
+LOCAL_PARSE_MIN_CONFIDENCE = float(os.getenv("LOCAL_PARSE_MIN_CONFIDENCE", "0.8"))
+# Longer queries are sentences, not keyword lists, and always go to the LLM
+LOCAL_PARSE_MAX_TOKENS = int(os.getenv("LOCAL_PARSE_MAX_TOKENS", "6"))
+
+# Title tokens are treated as known tags when they modify a category (come just
+# before one, like "maxi" in "Floral Maxi Dress") at least this often, and in at
+# least this share of the titles they're in. Brands, sizes and pack counts don't.
+LEXICON_SAMPLE_SIZE = int(os.getenv("LEXICON_SAMPLE_SIZE", "50000"))
+LEXICON_MIN_COUNT = int(os.getenv("LEXICON_MIN_COUNT", "5"))
+LEXICON_MIN_MODIFIER_SHARE = float(os.getenv("LEXICON_MIN_MODIFIER_SHARE", "0.5"))
+LEXICON_MODIFIER_WINDOW = 2
+# After a failed lexicon load (e.g. Postgres not up yet), parse with the
+# built-in tags only and try again after this long
+LEXICON_RETRY_SECONDS = float(os.getenv("LEXICON_RETRY_SECONDS", "30"))
+
+CATEGORIES = {
+    "dress", "skirt", "shirt", "t-shirt", "tee", "blouse", "top", "tank top",
+    "polo shirt", "sweater", "hoodie", "sweatshirt", "cardigan", "jacket", "coat",
+    "blazer", "vest", "jeans", "pants", "trousers", "shorts", "leggings", "joggers",
+    "jumpsuit", "romper", "overalls", "suit", "boot", "ankle boots", "rain boots",
+    "sneaker", "sandal", "heel", "high heels", "stiletto", "flats", "loafer",
+    "slipper", "shoe", "clog", "mule", "sock", "bag", "handbag", "backpack",
+    "purse", "wallet", "tote", "tote bag", "crossbody bag", "clutch", "belt",
+    "hat", "cap", "beanie", "scarf", "gloves", "sunglasses", "watch", "necklace",
+    "earring", "bracelet", "ring", "bikini", "swimsuit", "swim trunks", "bra",
+    "sports bra", "lingerie", "underwear", "pajamas", "robe", "tie", "costume",
+}
+
+TAGS = {
+    # Colors
+    "black", "white", "red", "blue", "navy", "green", "olive", "yellow", "orange",
+    "pink", "purple", "brown", "beige", "tan", "grey", "gray", "gold", "silver",
+    "cream", "khaki", "burgundy", "denim", "floral", "striped", "plaid",
+    # Materials
+    "leather", "suede", "linen", "cotton", "wool", "cashmere", "silk", "satin",
+    "velvet", "lace", "knit", "fleece", "canvas", "faux", "fur", "mesh",
+    # Seasons, occasions and aesthetics
+    "summer", "winter", "spring", "fall", "autumn", "casual", "formal", "party",
+    "wedding", "beach", "workout", "running", "hiking", "office", "work",
+    "vintage", "boho", "minimalist", "sporty", "cute", "elegant", "cozy", "chic",
+    "oversized", "slim", "fitted", "loose", "waterproof", "warm", "lightweight",
+    # Audience
+    "men", "mens", "men's", "women", "womens", "women's", "kids", "girls", "boys",
+    "unisex",
+}
+
+# Connectors that carry no meaning for either field and don't count against a parse
+STOPWORDS = {"a", "an", "the", "and", "or", "for", "with", "in", "of", "to", "on"}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+
+
+def tokenize(value: str) -> List[str]:
+    return TOKEN_PATTERN.findall(value.lower())
+
+
+# Categories only named in the plural, with the singulars that mean the same
+# item. The rest aren't categories: "short dress" is a dress, "flat sandals"
+# are sandals.
+PLURAL_CATEGORIES = {
+    "jeans": [], "pants": [], "trousers": [], "shorts": [], "leggings": [],
+    "joggers": ["jogger"], "overalls": [], "flats": [], "gloves": ["glove"],
+    "sunglasses": [], "pajamas": [], "ankle boots": ["ankle boot"],
+    "rain boots": ["rain boot"], "high heels": ["high heel"], "swim trunks": [],
+}
+
+
+def pluralize(phrase: str) -> str:
+    return phrase + ("es" if phrase.endswith(("s", "sh", "ch", "x")) else "s")
+
+
+def category_forms(category: str) -> List[str]:
+    if category in PLURAL_CATEGORIES:
+        return [category] + PLURAL_CATEGORIES[category]
+    return [category, pluralize(category)]
+
+
+# Every spelling a category is matched on, e.g. "boot" and "boots" but not "short"
+CATEGORY_FORMS = {form for category in CATEGORIES for form in category_forms(category)}
+
+
+class LocalQueryParser:
+    """Lexicon based parser for short keyword queries like "red sneakers".
+
+    Returns the same shape as parse_query plus a confidence score: the share of
+    meaningful query tokens recognized as a category or tag. Queries without a
+    recognized category, or longer than LOCAL_PARSE_MAX_TOKENS, score 0 so the
+    LLM handles them. Of adjacent categories only the last is the category, the
+    ones before it modify it: "dress shoes" are shoes tagged "dress".
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0
+        self._catalog_tags = None
+        self._retry_at = 0.0
+        self.load_errors = 0
+        self._lock = threading.Lock()
+
+    def parse(self, query: str) -> Tuple[Dict[str, List[str]], float]:
+        all_tokens = tokenize(query)
+        meaningful = sum(t not in STOPWORDS for t in all_tokens)
+        if not meaningful or meaningful > LOCAL_PARSE_MAX_TOKENS:
+            return {"category": [], "tags": []}, 0.0
+
+        catalog_tags = self._get_catalog_tags()
+        # (is category, phrase) per recognized phrase, None for anything else
+        matches = []
+        recognized = 0
+        i = 0
+        while i < len(all_tokens):
+            token = all_tokens[i]
+            bigram = f"{token} {all_tokens[i + 1]}" if i + 1 < len(all_tokens) else None
+            if bigram in CATEGORY_FORMS:
+                matches.append((True, bigram))
+                recognized += 2
+                i += 2
+                continue
+            if token in CATEGORY_FORMS:
+                matches.append((True, token))
+                recognized += 1
+            elif token in TAGS or token in catalog_tags:
+                matches.append((False, token))
+                recognized += 1
+            else:
+                # Stopwords too, so "shirt and shorts" stays two categories
+                matches.append(None)
+            i += 1
+
+        categories = []
+        tags = []
+        for match, following in zip(matches, matches[1:] + [None]):
+            if match is None:
+                continue
+            is_category, phrase = match
+            if is_category and not (following and following[0]):
+                categories.append(phrase)
+            else:
+                tags.append(phrase)
+
+        parsed = {
+            "category": list(dict.fromkeys(categories)),
+            "tags": list(dict.fromkeys(tags)),
+        }
+        confidence = recognized / meaningful if categories else 0.0
+        return parsed, confidence
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "catalog_tags": len(self._catalog_tags) if self._catalog_tags is not None else None,
+            "catalog_tag_load_errors": self.load_errors,
+        }
+
+    def _get_catalog_tags(self) -> set:
+        if self._catalog_tags is None and time.monotonic() >= self._retry_at:
+            with self._lock:
+                if self._catalog_tags is None and time.monotonic() >= self._retry_at:
+                    # Failures aren't cached, only delay the next attempt
+                    self._catalog_tags = self._load_catalog_tags()
+                    if self._catalog_tags is None:
+                        self.load_errors += 1
+                        self._retry_at = time.monotonic() + LEXICON_RETRY_SECONDS
+        return self._catalog_tags if self._catalog_tags is not None else set()
+
+    def _load_catalog_tags(self) -> Optional[set]:
+        # Built once per process from a sample of live product titles
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                text('SELECT title FROM products WHERE "deletedAt" IS NULL LIMIT :limit'),
+                {"limit": LEXICON_SAMPLE_SIZE},
+            ).fetchall()
+        except Exception:
+            logger.exception(
+                "Error loading catalog lexicon, using built-in tags only for %ss",
+                LEXICON_RETRY_SECONDS,
+            )
+            return None
+        finally:
+            db.close()
+
+        return catalog_tags([row.title for row in rows])
+
+
+def catalog_tags(titles: List[str]) -> set:
+    """Title tokens that mostly appear as modifiers of a category, like "maxi"."""
+    counts = Counter()
+    modifier_counts = Counter()
+    for title in titles:
+        tokens = tokenize(title)
+        modifiers = set()
+        for i, token in enumerate(tokens):
+            bigram = f"{token} {tokens[i + 1]}" if i + 1 < len(tokens) else None
+            if token in CATEGORY_FORMS or bigram in CATEGORY_FORMS:
+                modifiers.update(tokens[max(i - LEXICON_MODIFIER_WINDOW, 0) : i])
+        counts.update(set(tokens))
+        modifier_counts.update(modifiers)
+    return {
+        token
+        for token, count in modifier_counts.items()
+        if count >= LEXICON_MIN_COUNT
+        and count >= LEXICON_MIN_MODIFIER_SHARE * counts[token]
+        and token.isalpha()
+        and len(token) >= 3
+        and token not in STOPWORDS
+        and token not in CATEGORY_FORMS
+    }
+
+
+local_parser = LocalQueryParser()
+
+
+if __name__ == "__main__":
+    titles = (
+        ["Amazon Essentials Women's Floral Maxi Dress"] * 5
+        + ["Amazon Essentials Men's Crew Neck T-Shirt, Pack of 2"] * 5
+        + ["Ribbed Midi Skirt"] * 5
+    )
+    tags = catalog_tags(titles)
+    print(sorted(tags))
+    assert {"floral", "maxi", "midi", "neck"} <= tags
+    assert not {"amazon", "essentials", "pack"} & tags
+
+    parser = LocalQueryParser()
+    parser._catalog_tags = tags
+    for query, expected in [
+        ("red sneakers", {"category": ["sneakers"], "tags": ["red"]}),
+        ("shorts", {"category": ["shorts"], "tags": []}),
+        ("short dress", {"category": ["dress"], "tags": []}),
+        ("dress pants", {"category": ["pants"], "tags": ["dress"]}),
+        ("dress shoes men", {"category": ["shoes"], "tags": ["dress", "men"]}),
+        ("boot socks", {"category": ["socks"], "tags": ["boot"]}),
+        ("belt bag", {"category": ["bag"], "tags": ["belt"]}),
+        ("shirt and shorts", {"category": ["shirt", "shorts"], "tags": []}),
+        ("black ankle boots", {"category": ["ankle boots"], "tags": ["black"]}),
+        ("floral maxi dress", {"category": ["dress"], "tags": ["floral", "maxi"]}),
+    ]:
+        parsed, confidence = parser.parse(query)
+        print(f"{query!r} => {parsed} {confidence:.2f}")
+        assert parsed == expected, (query, parsed)
+    assert parser.parse("a red dress I can wear to a summer wedding in italy")[1] == 0
+
+    # A failed lexicon load isn't cached: parses use the built-in tags until a retry succeeds
+    failing = LocalQueryParser()
+    failing._load_catalog_tags = lambda: None
+    assert failing.parse("maxi dress") == ({"category": ["dress"], "tags": []}, 0.5)
+    assert failing.load_errors == 1 and failing._catalog_tags is None
+    failing.parse("maxi dress")
+    assert failing.load_errors == 1  # backing off
+    failing._retry_at = 0.0
+    failing._load_catalog_tags = lambda: tags
+    assert failing.parse("maxi dress") == ({"category": ["dress"], "tags": ["maxi"]}, 1.0)
@@ -1,19 +1,80 @@
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+import json
+import logging
+import os
+import threading
+import time
 
-from app.database import SessionLocal
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
 from app.models import Product
 from app.schemas import Product as ProductSchema
-from app.parse_query import parse_query
-from app.clip_embedder import embed_text
+from app.parse_query import get_client, parse_query, parse_cache_stats
+from app.clip_embedder import (
+    configure_process_threads,
+    embed_text,
+    embedding_batcher_stats,
+    embedding_cache_stats,
+    is_model_loaded,
+    warm_up,
+)
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.search import SearchService
+from app.metrics import record_search, render_metrics
+from app.reranker import rule_engine
+from app.semantic_cache import semantic_cache
+from app.search import (
+    BATCH_SEARCH_MAX_QUERIES,
+    DEFAULT_SEARCH_PROFILE,
+    SEARCH_PROFILES,
+    InvalidCursor,
+    SearchService,
+    product_cache,
+    ranking_cache,
+    result_cache,
+)
+
+# Per-request details are logged at DEBUG, warnings and errors at WARNING and up
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(
+    level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Load the CLIP model and OpenAI client when the worker starts instead of on
+# the first search
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+
+
+def run_warm_up():
+    try:
+        get_client()
+        warm_up()
+        logger.info("Warm up complete")
+    except Exception:
+        logger.exception("Error during warm up")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # On the main thread before any other thread starts, so the warm-up,
+    # embedding batcher and encoder threads all inherit the CPU affinity
+    configure_process_threads()
+    if WARMUP_ON_STARTUP:
+        # In the background, so the worker answers health checks right away
+        threading.Thread(target=run_warm_up, name="warm-up", daemon=True).start()
+    yield
+    await async_engine.dispose()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 router = APIRouter()
 
 # CORS
@@ -23,6 +84,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Next-Cursor"],
 )
 
 
@@ -35,22 +97,190 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 class UserPreferences(BaseModel):
     gender: Optional[str] = None
     price: Optional[str] = None
     styles: Optional[List[str]] = None
 
 
+class BatchSearchQuery(BaseModel):
+    q: str = Field(..., min_length=1)
+    preferences: Optional[UserPreferences] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchSearchQuery]
+
+
+class BatchSearchResult(BaseModel):
+    q: str
+    products: List[ProductSchema]
+
+
+def check_profile(profile: str):
+    if profile not in SEARCH_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown profile {profile!r}, expected one of {list(SEARCH_PROFILES)}",
+        )
+
+
 @router.post("/products/search", response_model=List[ProductSchema])
-def search_products(
+async def search_products(
     q: str = Query(..., min_length=1),
     preferences: Optional[UserPreferences] = None,
-    db: Session = Depends(get_db)
+    profile: str = Query(DEFAULT_SEARCH_PROFILE),
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    print("Searching for", q)
-    print("Preferences", preferences)
-    search = SearchService(user_preferences=preferences)
-    return search.search_products(q, db)
+    start = time.perf_counter()
+    logger.debug("Searching for %r with preferences %s", q, preferences)
+    check_profile(profile)
+    search = SearchService(user_preferences=preferences, search_profile=profile)
+    try:
+        products = await search.search_products(q, db, limit=limit, cursor=cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Serialized here rather than by FastAPI, so it's part of the timings
+    body = search._timed("serialize", lambda: json.dumps(jsonable_encoder(products)))
+    response = Response(content=body, media_type="application/json")
+    if search.next_cursor:
+        # Pass back as cursor (with the same q) for the next page
+        response.headers["X-Next-Cursor"] = search.next_cursor
+    # Per-stage timings (parse, each retrieval branch, rerank, hydrate, serialize)
+    response.headers["Server-Timing"] = search.server_timing()
+    record_search(
+        "search",
+        search.timings,
+        (time.perf_counter() - start) * 1000,
+        q=q,
+        profile=profile,
+        results=len(products),
+        fell_back=search.fell_back,
+    )
+    return response
+
+
+@router.post("/products/search/stream")
+async def stream_search_products(
+    q: str = Query(..., min_length=1),
+    preferences: Optional[UserPreferences] = None,
+    profile: str = Query(DEFAULT_SEARCH_PROFILE),
+    limit: Optional[int] = Query(None, ge=1),
+):
+    start = time.perf_counter()
+    logger.debug("Streaming search for %r", q)
+    check_profile(profile)
+    search = SearchService(user_preferences=preferences, search_profile=profile)
+
+    async def events():
+        # The session is opened here, since the stream outlives the handler
+        async with AsyncSessionLocal() as db:
+            try:
+                async for event in search.stream_products(q, db, limit=limit):
+                    yield search._timed(
+                        f"serialize_{event['type']}",
+                        lambda: json.dumps(jsonable_encoder(event)) + "\n",
+                    )
+            except Exception:
+                logger.exception("Error in streamed search")
+                yield json.dumps({"type": "error", "detail": "Search failed"}) + "\n"
+                return
+        record_search(
+            "stream",
+            search.timings,
+            (time.perf_counter() - start) * 1000,
+            q=q,
+            profile=profile,
+            fell_back=search.fell_back,
+        )
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@router.post("/products/search/batch", response_model=List[BatchSearchResult])
+async def batch_search_products(
+    request: BatchSearchRequest,
+    profile: str = Query(DEFAULT_SEARCH_PROFILE),
+    limit: Optional[int] = Query(None, ge=1),
+    db: AsyncSession = Depends(get_async_db),
+):
+    start = time.perf_counter()
+    logger.debug("Batch searching %d queries", len(request.queries))
+    check_profile(profile)
+    if len(request.queries) > BATCH_SEARCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {BATCH_SEARCH_MAX_QUERIES} queries per batch",
+        )
+    search = SearchService(user_preferences=None, search_profile=profile)
+    results = await search.search_batch(
+        [(item.q, item.preferences) for item in request.queries], db, limit=limit
+    )
+    body = search._timed(
+        "serialize",
+        lambda: json.dumps(
+            jsonable_encoder(
+                [
+                    {"q": item.q, "products": products}
+                    for item, products in zip(request.queries, results)
+                ]
+            )
+        ),
+    )
+    response = Response(content=body, media_type="application/json")
+    response.headers["Server-Timing"] = search.server_timing()
+    record_search(
+        "batch",
+        search.timings,
+        (time.perf_counter() - start) * 1000,
+        queries=len(request.queries),
+        profile=profile,
+    )
+    return response
+
+
+@router.get("/health")
+def health():
+    return {"status": "ok", "model_loaded": is_model_loaded()}
+
+
+@router.get("/ready")
+def ready(response: Response):
+    # Not ready until the embedding model is in memory
+    model_loaded = is_model_loaded()
+    if not model_loaded:
+        response.status_code = 503
+    return {"ready": model_loaded, "model_loaded": model_loaded}
+
+
+@router.get("/stats")
+def stats():
+    return {
+        "parse_cache": parse_cache_stats(),
+        "embedding_cache": embedding_cache_stats(),
+        "embedding_batcher": embedding_batcher_stats(),
+        "cursor_cache": ranking_cache.stats(),
+        "result_cache": result_cache.stats(),
+        "product_cache": product_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "reranking": rule_engine.stats(),
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text format, per worker process
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 
 app.include_router(router)
 
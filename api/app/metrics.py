@@ -0,0 +1,109 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+
+# Per-request trace logs: a sampled share of searches, plus every search slower
+# than SEARCH_TRACE_SLOW_MS (0 turns that off), logged to the app.trace logger
+SEARCH_TRACE_SAMPLE_RATE = float(os.getenv("SEARCH_TRACE_SAMPLE_RATE", "0.01"))
+SEARCH_TRACE_SLOW_MS = float(os.getenv("SEARCH_TRACE_SLOW_MS", "1000"))
+
+# Seconds, as Prometheus expects; from a cached lookup up to a slow LLM parse
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+trace_logger = logging.getLogger("app.trace")
+
+
+class Histogram:
+    """Latency histogram per label values, rendered in Prometheus' text format.
+
+    Counts are per worker process; Prometheus sums them across scrape targets.
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, seconds: float):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += seconds
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(
+                f'{name}="{value}"' for name, value in zip(self.label_names, label_values)
+            )
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+search_duration = Histogram(
+    "search_request_duration_seconds",
+    "Search latency, from the handler until the response body is serialized.",
+    ("endpoint",),
+)
+search_stage_duration = Histogram(
+    "search_stage_duration_seconds",
+    "Latency of each search stage. Concurrent stages overlap.",
+    ("endpoint", "stage"),
+)
+
+
+def record_search(endpoint: str, timings: dict, duration_ms: float, **trace):
+    """Observes a finished search and its stage timings (in ms), tracing it if sampled or slow."""
+    search_duration.observe((endpoint,), duration_ms / 1000)
+    for stage, stage_ms in timings.items():
+        search_stage_duration.observe((endpoint, stage), stage_ms / 1000)
+
+    slow = SEARCH_TRACE_SLOW_MS and duration_ms >= SEARCH_TRACE_SLOW_MS
+    if slow or random.random() < SEARCH_TRACE_SAMPLE_RATE:
+        trace_logger.log(
+            logging.WARNING if slow else logging.INFO,
+            json.dumps(
+                {
+                    "endpoint": endpoint,
+                    "duration_ms": round(duration_ms, 2),
+                    "stages": {stage: round(ms, 2) for stage, ms in timings.items()},
+                    **trace,
+                },
+                default=str,
+            ),
+        )
+
+
+def render_metrics() -> str:
+    lines = search_duration.render() + search_stage_duration.render()
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    histogram = Histogram("test_seconds", "Test.", ("stage",), buckets=(0.01, 0.1))
+    for seconds in (0.005, 0.01, 0.05, 2):
+        histogram.observe(("parse",), seconds)
+    rendered = histogram.render()
+    print("\n".join(rendered))
+    assert 'test_seconds_bucket{stage="parse",le="0.01"} 2' in rendered
+    assert 'test_seconds_bucket{stage="parse",le="0.1"} 3' in rendered
+    assert 'test_seconds_bucket{stage="parse",le="+Inf"} 4' in rendered
+    assert 'test_seconds_count{stage="parse"} 4' in rendered
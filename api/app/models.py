@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime, Text, ARRAY
+from sqlalchemy import Column, BigInteger, Integer, Float, String, DateTime, Text, ARRAY, Index, text
 from sqlalchemy.sql import func
 from .database import Base
 from pgvector.sqlalchemy import Vector
 
+# Rows the search path can return. Retrieval queries must filter on exactly this
+# predicate for Postgres to use the partial indexes below.
+LIVE_PRODUCTS = '"deletedAt" IS NULL'
+LIVE_EMBEDDED_PRODUCTS = 'embedding IS NOT NULL AND "deletedAt" IS NULL'
+
 
 class Product(Base):
     __tablename__ = "products"
@@ -16,7 +21,51 @@ class Product(Base):
     average_rating = Column(Float)
     rating_number = Column(Integer)
     store = Column(String)
+    # Query independent part of the rerank score, see app.reranker.quality_score
+    quality_score = Column(Float, nullable=True)
+    # RuleSet.version of the rules quality_score was computed with
+    quality_score_rules = Column(String, nullable=True)
     embedding = Column(Vector(512), nullable=True)
     createdAt = Column(DateTime(timezone=True), server_default=func.now())
     modifiedAt = Column(DateTime(timezone=True), onupdate=func.now())
     deletedAt = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Only live, embedded rows are in the HNSW graph, so soft deletes don't
+        # eat into the ANN results
+        Index(
+            "products_embedding_live_hnsw_idx",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 1000},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+            postgresql_where=text(LIVE_EMBEDDED_PRODUCTS),
+        ),
+        # Trigram index so title ILIKE '%keyword%' doesn't scan the table
+        Index(
+            "products_title_trgm_idx",
+            "title",
+            postgresql_using="gin",
+            postgresql_ops={"title": "gin_trgm_ops"},
+            postgresql_where=text(LIVE_PRODUCTS),
+        ),
+        # Trigram index the title search walks in word similarity order, for
+        # keywords too common for the GIN index to narrow down
+        Index(
+            "products_title_trgm_gist_idx",
+            "title",
+            postgresql_using="gist",
+            postgresql_ops={"title": "gist_trgm_ops"},
+            postgresql_where=text(LIVE_PRODUCTS),
+        ),
+    )
+
+
+class CatalogState(Base):
+    """Single row whose version is bumped by every catalog write, so search caches can tell."""
+
+    __tablename__ = "catalog_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, server_default="0")
+    modifiedAt = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
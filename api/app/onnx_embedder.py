@@ -0,0 +1,123 @@
+import os
+import threading
+
+import numpy as np
+
+from app.clip_embedder import MODEL_NAME, TorchTextEncoder
+
+# Exported models are written here on first use and reused afterwards
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+ONNX_OPSET_VERSION = 14
+
+_export_lock = threading.Lock()
+
+
+def model_paths(model_dir: str = ONNX_MODEL_DIR) -> tuple[str, str]:
+    base = os.path.join(model_dir, MODEL_NAME.replace("/", "__"))
+    return f"{base}.text.onnx", f"{base}.text.int8.onnx"
+
+
+def export_text_encoder(path: str):
+    """Exports the CLIP text tower, including L2 normalization, to ONNX."""
+    import torch
+
+    class NormalizedTextFeatures(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            features = self.model.get_text_features(
+                input_ids=input_ids, attention_mask=attention_mask
+            )
+            return features / features.norm(dim=-1, keepdim=True)
+
+    encoder = TorchTextEncoder()
+    inputs = encoder.processor(
+        text=["a pair of brown leather boots"], return_tensors="pt", padding=True
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Written under a temporary name so other workers never load a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            NormalizedTextFeatures(encoder.model),
+            (inputs["input_ids"], inputs["attention_mask"]),
+            tmp_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "embeddings": {0: "batch"},
+            },
+            opset_version=ONNX_OPSET_VERSION,
+        )
+    os.replace(tmp_path, path)
+    print(f"Exported text encoder to {path}")
+
+
+def quantize_text_encoder(fp32_path: str, int8_path: str):
+    """Dynamically quantizes the exported model's weights to int8."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+    quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_path)
+    print(f"Quantized text encoder to {int8_path}")
+
+
+def ensure_exported(quantized: bool = False, model_dir: str = ONNX_MODEL_DIR) -> str:
+    fp32_path, int8_path = model_paths(model_dir)
+    with _export_lock:
+        if not os.path.exists(fp32_path):
+            export_text_encoder(fp32_path)
+        if quantized and not os.path.exists(int8_path):
+            quantize_text_encoder(fp32_path, int8_path)
+    return int8_path if quantized else fp32_path
+
+
+class ONNXTextEncoder:
+    """CLIP text tower on ONNX Runtime, optionally int8 quantized.
+
+    Only the tokenizer and the ONNX graph are kept in memory; the PyTorch model
+    is loaded just once to export the graph if it doesn't exist yet.
+    """
+
+    def __init__(
+        self,
+        quantized: bool = False,
+        model_dir: str = ONNX_MODEL_DIR,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+    ):
+        import onnxruntime as ort
+        from transformers import CLIPTokenizerFast
+
+        path = ensure_exported(quantized=quantized, model_dir=model_dir)
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(MODEL_NAME)
+        options = ort.SessionOptions()
+        # 0 lets ONNX Runtime use all cores the process is allowed to run on
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts, return_tensors="np", padding=True, truncation=True
+        )
+        (embeddings,) = self.session.run(
+            ["embeddings"],
+            {
+                "input_ids": inputs["input_ids"].astype(np.int64),
+                "attention_mask": inputs["attention_mask"].astype(np.int64),
+            },
+        )
+        return embeddings.astype(np.float32)
+
+
+if __name__ == "__main__":
+    # Export (and quantize) ahead of deploys so workers don't do it on startup
+    print(ensure_exported(quantized=True))
@@ -1,12 +1,28 @@
-from openai import OpenAI
+import hashlib
 import os
 import re
-from typing import List, Dict
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
 
+from app.cache import SQLiteCache, TTLCache
+from app.local_parser import (
+    LOCAL_PARSE_ENABLED,
+    LOCAL_PARSE_MIN_CONFIDENCE,
+    local_parser,
+)
+
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Created on first use so importing this module stays cheap
+client = None
+
+PARSE_MODEL = "gpt-4-0125-preview"
+
+# Parses are cached per (prompt version, normalized query). The in-process LRU
+# is always on; the SQLite tier is shared by workers and survives restarts.
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "10000"))
+PARSE_CACHE_TTL_SECONDS = float(os.getenv("PARSE_CACHE_TTL_SECONDS", "86400"))
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH")
 
 FASHION_QUERY_PROMPT = """
 You are an expert fashion stylist. Your task is to extract the item category and relevant style tags from a user's query.
@@ -21,6 +37,18 @@ Category: <comma-separated list>
 Tags: <comma-separated list>
 """.strip()
 
+# Changes whenever the prompt or model does, so stale parses are never served
+PROMPT_VERSION = hashlib.sha256(
+    f"{PARSE_MODEL}\n{FASHION_QUERY_PROMPT}".encode()
+).hexdigest()[:12]
+
+parse_cache = TTLCache(maxsize=PARSE_CACHE_SIZE, ttl=PARSE_CACHE_TTL_SECONDS)
+disk_parse_cache = (
+    SQLiteCache(PARSE_CACHE_PATH, maxsize=PARSE_CACHE_SIZE * 10, ttl=PARSE_CACHE_TTL_SECONDS)
+    if PARSE_CACHE_PATH
+    else None
+)
+
 
 def postprocess(items: List[str], disallow_prefix: str = "") -> List[str]:
     clean = [i.lower().strip() for i in items if i]
@@ -29,11 +57,71 @@ def postprocess(items: List[str], disallow_prefix: str = "") -> List[str]:
     return list(dict.fromkeys(clean))  # dedupe
 
 
+def get_client():
+    global client
+    if client is None:
+        from openai import OpenAI
+
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return client
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
 def parse_query(query: str) -> Dict[str, List[str]]:
+    parsed = parse_query_without_llm(query)
+    if parsed is None:
+        parsed = parse_query_with_llm(query)
+    return parsed
+
+
+def parse_query_without_llm(query: str) -> Optional[Dict[str, List[str]]]:
+    """The cached or confident local parse, or None if the query needs the LLM."""
+    key = f"{PROMPT_VERSION}:{normalize_query(query)}"
+
+    parsed = parse_cache.get(key)
+    if parsed is None and disk_parse_cache is not None:
+        parsed = disk_parse_cache.get(key)
+        if parsed is not None:
+            parse_cache.set(key, parsed)
+    if parsed is not None:
+        # Callers add keys to the result, so never hand out the cached lists
+        return {k: list(v) for k, v in parsed.items()}
+
+    if LOCAL_PARSE_ENABLED:
+        # Short keyword queries are handled locally without an LLM round trip
+        local_parsed, confidence = local_parser.parse(query)
+        if confidence >= LOCAL_PARSE_MIN_CONFIDENCE:
+            local_parser.accepted += 1
+            return local_parsed
+        local_parser.rejected += 1
+    return None
+
+
+def parse_query_with_llm(query: str) -> Dict[str, List[str]]:
+    key = f"{PROMPT_VERSION}:{normalize_query(query)}"
+    parsed = _parse_query_llm(query)
+    parse_cache.set(key, parsed)
+    if disk_parse_cache is not None:
+        disk_parse_cache.set(key, parsed)
+    return {k: list(v) for k, v in parsed.items()}
+
+
+def parse_cache_stats() -> dict:
+    return {
+        "memory": parse_cache.stats(),
+        "disk": disk_parse_cache.stats() if disk_parse_cache is not None else None,
+        "local_parser": local_parser.stats(),
+    }
+
+
+def _parse_query_llm(query: str) -> Dict[str, List[str]]:
     prompt = FASHION_QUERY_PROMPT.replace("{query}", query)
 
-    response = client.chat.completions.create(
-        model="gpt-4-0125-preview",  # or your version
+    response = get_client().chat.completions.create(
+        model=PARSE_MODEL,
         messages=[{"role": "user", "content": prompt}],
         temperature=0,
     )
@@ -0,0 +1,522 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Each rule adds weight to a candidate's score:
+# - flag: when a boolean column is true
+# - scaled: when a numeric column passes threshold, times the value (capped at
+#   the optional ceiling) over normalization_constant
+# Rules are applied in order. RERANKING_RULES_PATH points to a JSON list in the
+# same format that replaces these, and is reloaded when the file changes.
+DEFAULT_RERANKING_RULES = [
+    {"name": "no_photo", "type": "flag", "field": "no_photo", "weight": -0.5},
+    {"name": "marked_for_archive", "type": "flag", "field": "marked_for_archive", "weight": -1},
+    {
+        "name": "high_average_rating",
+        "type": "scaled",
+        "field": "average_rating",
+        "op": ">=",
+        "threshold": 4,
+        "normalization_constant": 5,
+        "weight": 0.5,
+    },
+    {
+        "name": "low_average_rating",
+        "type": "scaled",
+        "field": "average_rating",
+        "op": "<",
+        "threshold": 2,
+        "normalization_constant": 2,
+        "weight": -0.5,
+    },
+    {
+        "name": "high_rating_number",
+        "type": "scaled",
+        "field": "rating_number",
+        "op": ">",
+        "threshold": 30,
+        "ceiling": 200,
+        "normalization_constant": 200,
+        "weight": 0.2,
+    },
+]
+
+RERANKING_RULES_PATH = os.getenv("RERANKING_RULES_PATH", "")
+RERANKING_RULES_POLL_SECONDS = float(os.getenv("RERANKING_RULES_POLL_SECONDS", "5"))
+
+# None of the rules depend on the query, so their sum is stored per product as
+# quality_score at ingest, with the version of the rules it was computed with,
+# and search only adds it. Products scored with other rules (or none yet) are
+# scored with the live rules. Turn off to always use the live rules.
+STORED_QUALITY_SCORE = os.getenv("STORED_QUALITY_SCORE", "true").lower() == "true"
+# Rule stats are only measured when rules run, so every nth request served
+# entirely from stored scores also runs them, for stats only (0 never does)
+RERANKING_STATS_SAMPLE_EVERY = int(os.getenv("RERANKING_STATS_SAMPLE_EVERY", "20"))
+
+# The "no image available" placeholder
+NO_PHOTO_URL = "https://m.media-amazon.com/images/I/01RmK+J4pJL._AC_.gif"
+MARKED_FOR_ARCHIVE_TITLE = "Marked For Archive"
+
+
+FLAG_FIELDS = ("no_photo", "marked_for_archive")
+NUMERIC_FIELDS = ("average_rating", "rating_number")
+COMPARISONS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+
+def candidate_columns(candidates: Sequence) -> dict[str, np.ndarray]:
+    """Columnar arrays of the fields the rules read, one entry per candidate."""
+    n = len(candidates)
+    return {
+        "similarity": np.fromiter(
+            (c.similarity or 0 for c in candidates), dtype=np.float64, count=n
+        ),
+        "average_rating": np.fromiter(
+            (c.average_rating or 0 for c in candidates), dtype=np.float64, count=n
+        ),
+        "rating_number": np.fromiter(
+            (c.rating_number or 0 for c in candidates), dtype=np.float64, count=n
+        ),
+        "no_photo": np.fromiter(
+            (c.first_image_url == NO_PHOTO_URL for c in candidates), dtype=bool, count=n
+        ),
+        "marked_for_archive": np.fromiter(
+            (c.title == MARKED_FOR_ARCHIVE_TITLE for c in candidates), dtype=bool, count=n
+        ),
+        # NaN where the product has no stored score yet
+        "quality_score": np.fromiter(
+            (
+                np.nan if getattr(c, "quality_score", None) is None else c.quality_score
+                for c in candidates
+            ),
+            dtype=np.float64,
+            count=n,
+        ),
+        # RuleSet.version the stored score was computed with
+        "quality_score_rules": np.array(
+            [getattr(c, "quality_score_rules", None) for c in candidates], dtype=object
+        ),
+    }
+
+
+def compile_rule(rule: dict) -> Callable[[dict], np.ndarray]:
+    """Validates a rule and binds its settings into a function of the columns."""
+    name = rule.get("name")
+    if not name:
+        raise ValueError(f"Reranking rule without a name: {rule}")
+    weight = float(rule["weight"])
+
+    if rule["type"] == "flag":
+        field = rule["field"]
+        if field not in FLAG_FIELDS:
+            raise ValueError(f"Rule {name}: flag field must be one of {FLAG_FIELDS}")
+
+        def contribution(columns):
+            return np.where(columns[field], weight, 0.0)
+
+    elif rule["type"] == "scaled":
+        field = rule["field"]
+        if field not in NUMERIC_FIELDS:
+            raise ValueError(f"Rule {name}: scaled field must be one of {NUMERIC_FIELDS}")
+        if rule["op"] not in COMPARISONS:
+            raise ValueError(f"Rule {name}: op must be one of {list(COMPARISONS)}")
+        compare = COMPARISONS[rule["op"]]
+        threshold = float(rule["threshold"])
+        normalization_constant = float(rule["normalization_constant"])
+        ceiling = rule.get("ceiling")
+
+        def contribution(columns):
+            values = columns[field]
+            capped = values if ceiling is None else np.minimum(values, ceiling)
+            return np.where(
+                compare(values, threshold),
+                capped / normalization_constant * weight,
+                0.0,
+            )
+
+    else:
+        raise ValueError(f"Rule {name}: unknown type {rule['type']!r}")
+
+    return contribution
+
+
+class RuleSet:
+    """Reranking rules compiled once, with per-rule counts and timings."""
+
+    def __init__(self, rules: list[dict], source: str = "default"):
+        self.rules = rules
+        self.source = source
+        # Identifies these rules in products.quality_score_rules
+        self.version = hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:12]
+        self.loaded_at = time.time()
+        self.compiled = [(rule["name"], compile_rule(rule)) for rule in rules]
+        self.requests = 0
+        self.candidates = 0
+        self.stored_score_requests = 0
+        self.stored_candidates = 0
+        # Rule name -> [candidates it changed the score of, total contribution, total seconds]
+        self.rule_stats = {name: [0, 0.0, 0.0] for name, _ in self.compiled}
+        self._lock = threading.Lock()
+
+    def score(self, columns: dict[str, np.ndarray], use_stored: bool = False) -> np.ndarray:
+        """Reranked scores of every candidate.
+
+        With use_stored, similarity plus the stored quality score for the
+        candidates scored with these rules. The others get terms added in rule
+        order with 0 where a rule doesn't apply, so the default rules match the
+        original per-product loop exactly.
+        """
+        stored = np.zeros(len(columns["similarity"]), dtype=bool)
+        if use_stored:
+            stored = ~np.isnan(columns["quality_score"]) & (
+                columns["quality_score_rules"] == self.version
+            )
+        evaluate = ~stored
+        if len(stored) and stored.all():
+            with self._lock:
+                self.stored_score_requests += 1
+                sampled = (
+                    RERANKING_STATS_SAMPLE_EVERY
+                    and self.stored_score_requests % RERANKING_STATS_SAMPLE_EVERY == 0
+                )
+            if not sampled:
+                with self._lock:
+                    self.stored_candidates += len(stored)
+                return columns["similarity"] + columns["quality_score"]
+            evaluate = np.ones_like(stored)
+
+        score = np.where(stored, columns["similarity"] + columns["quality_score"], 0.0)
+        subset = {name: values[evaluate] for name, values in columns.items()}
+        live = subset["similarity"].copy()
+        measurements = []
+        for name, contribution in self.compiled:
+            start = time.perf_counter()
+            term = contribution(subset)
+            live += term
+            measurements.append(
+                (name, int(np.count_nonzero(term)), float(term.sum()), time.perf_counter() - start)
+            )
+        score[~stored] = live[~stored[evaluate]]
+
+        with self._lock:
+            self.requests += 1
+            self.candidates += len(live)
+            self.stored_candidates += int(np.count_nonzero(stored))
+            for name, applied, total, seconds in measurements:
+                stats = self.rule_stats[name]
+                stats[0] += applied
+                stats[1] += total
+                stats[2] += seconds
+        return score
+
+    def quality_scores(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """Sum of the rule contributions alone, without similarity."""
+        score = np.zeros(len(columns["similarity"]))
+        for _, contribution in self.compiled:
+            score += contribution(columns)
+        return score
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "source": self.source,
+                "loaded_at": self.loaded_at,
+                "requests": self.requests,
+                "candidates": self.candidates,
+                "stored_score_requests": self.stored_score_requests,
+                "stored_candidates": self.stored_candidates,
+                "version": self.version,
+                "rules": {
+                    name: {
+                        "applied": applied,
+                        "mean_contribution": total / applied if applied else 0,
+                        "mean_us": seconds * 1e6 / self.requests if self.requests else 0,
+                    }
+                    for name, (applied, total, seconds) in self.rule_stats.items()
+                },
+            }
+
+
+def load_rules(path: str) -> RuleSet:
+    with open(path) as f:
+        return RuleSet(json.load(f), source=path)
+
+
+class RuleEngine:
+    """Serves the current RuleSet, swapping in a new one when the rules file changes.
+
+    The file is checked at most every poll_seconds. A rules file that fails to
+    load or compile is logged and the previous rules stay in place.
+    """
+
+    def __init__(self, path: str = "", poll_seconds: float = 5):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.reloads = 0
+        self.reload_errors = 0
+        self._mtime = None
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        if path:
+            # A bad file at startup should stop the worker, not fall back silently
+            self._mtime = os.stat(path).st_mtime_ns
+            self.rules = load_rules(path)
+        else:
+            self.rules = RuleSet(DEFAULT_RERANKING_RULES)
+
+    def current(self) -> RuleSet:
+        if self.path and time.monotonic() - self._checked_at >= self.poll_seconds:
+            self._maybe_reload()
+        return self.rules
+
+    def _maybe_reload(self):
+        # Only one thread checks; the others keep using the current rules
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            # Each version of the file is tried once, even if it fails
+            self._mtime = mtime
+            rules = load_rules(self.path)
+            # A single reference swap, so a request sees either the old or new rules
+            self.rules = rules
+            self.reloads += 1
+            logger.info("Reloaded %d reranking rules from %s", len(rules.compiled), self.path)
+        except Exception:
+            self.reload_errors += 1
+            logger.exception("Error reloading reranking rules, keeping the previous ones")
+        finally:
+            self._lock.release()
+
+    def stats(self) -> dict:
+        return {
+            **self.rules.stats(),
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+        }
+
+
+rule_engine = RuleEngine(RERANKING_RULES_PATH, RERANKING_RULES_POLL_SECONDS)
+
+
+def quality_score(
+    title: str,
+    image_urls: Sequence[str],
+    average_rating: Optional[float],
+    rating_number: Optional[int],
+    rules: Optional[RuleSet] = None,
+) -> tuple[float, str]:
+    """A product's stored quality_score under the current rules, and their version."""
+    rules = rules or rule_engine.current()
+    product = SimpleNamespace(
+        similarity=0,
+        title=title,
+        first_image_url=image_urls[0] if image_urls else None,
+        average_rating=average_rating,
+        rating_number=rating_number,
+    )
+    return float(rules.quality_scores(candidate_columns([product]))[0]), rules.version
+
+
+def top_k(scores: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    """Indices of the k highest scores, best first, ties in input order.
+
+    Only the top k are sorted; the rest are split off with a partial selection.
+    """
+    if k is None or k >= len(scores):
+        indices = np.arange(len(scores))
+    else:
+        indices = np.argpartition(-scores, k - 1)[:k]
+    # lexsort's last key is the primary one
+    return indices[np.lexsort((indices, -scores[indices]))]
+
+
+def rerank(candidates: Sequence, k: Optional[int] = None, rules: Optional[RuleSet] = None) -> list:
+    """Best k candidates by reranked score, with similarity set to that score."""
+    if not candidates:
+        return []
+    rules = rules or rule_engine.current()
+    scores = rules.score(candidate_columns(candidates), use_stored=STORED_QUALITY_SCORE)
+    ranked = []
+    for i in top_k(scores, k):
+        candidate = candidates[i]
+        candidate.similarity = float(scores[i])
+        ranked.append(candidate)
+    return ranked
+
+
+if __name__ == "__main__":
+    import copy
+    import random
+
+    # The config the original loop read
+    RERANKING_CONFIG = {
+        "no_photo": {"weight": -0.5},
+        "marked_for_archive": {"weight": -1},
+        "high_average_rating": {
+            "threshold": 4,
+            "normalization_constant": 5,
+            "weight": 0.5,
+        },
+        "low_average_rating": {
+            "threshold": 2,
+            "normalization_constant": 2,
+            "weight": -0.5,
+        },
+        "high_rating_number": {
+            "threshold": 30,
+            "ceiling": 200,
+            "normalization_constant": 200,
+            "weight": 0.2,
+        },
+    }
+
+    def loop_rerank(products):
+        # Verbatim the per-product implementation this module replaced
+        for product in products:
+            score = product.similarity
+
+            # Penalize if the photo is "no image avaialable"
+            if len(product.imageUrls) > 0 and product.imageUrls[0] == [
+                "https://m.media-amazon.com/images/I/01RmK+J4pJL._AC_.gif"
+            ]:
+                score += RERANKING_CONFIG["no_photo"]["weight"]
+
+            # Penalize if title marked for archive
+            if product.title and product.title == "Marked For Archive":
+                score += RERANKING_CONFIG["marked_for_archive"]["weight"]
+
+            avg_rating = product.average_rating if product.average_rating else 0
+            if avg_rating >= RERANKING_CONFIG["high_average_rating"]["threshold"]:
+                norm_rating = (
+                    avg_rating
+                    / RERANKING_CONFIG["high_average_rating"]["normalization_constant"]
+                )
+                score += norm_rating * RERANKING_CONFIG["high_average_rating"]["weight"]
+
+            if avg_rating < RERANKING_CONFIG["low_average_rating"]["threshold"]:
+                norm_rating = (
+                    avg_rating
+                    / RERANKING_CONFIG["low_average_rating"]["normalization_constant"]
+                )
+                score += norm_rating * RERANKING_CONFIG["low_average_rating"]["weight"]
+
+            rating_number = product.rating_number if product.rating_number else 0
+            if rating_number > RERANKING_CONFIG["high_rating_number"]["threshold"]:
+                capped_count = min(
+                    rating_number, RERANKING_CONFIG["high_rating_number"]["ceiling"]
+                )
+                norm_count = (
+                    capped_count
+                    / RERANKING_CONFIG["high_rating_number"]["normalization_constant"]
+                )
+                score += norm_count * RERANKING_CONFIG["high_rating_number"]["weight"]
+
+            product.similarity = score
+
+        return sorted(products, key=lambda x: x.similarity, reverse=True)
+
+    def candidate(similarity, average_rating, rating_number, title="Product", no_photo=False):
+        image_url = NO_PHOTO_URL if no_photo else "https://example.com/photo.jpg"
+        return SimpleNamespace(
+            id=f"{title}-{random.random()}",
+            similarity=similarity,
+            title=title,
+            imageUrls=[image_url],
+            first_image_url=image_url,
+            average_rating=average_rating,
+            rating_number=rating_number,
+        )
+
+    # The loop compared the first image URL to a list, so the no_photo penalty
+    # never applied. The rules do apply it; without it they match the loop.
+    LOOP_RULES = [rule for rule in DEFAULT_RERANKING_RULES if rule["name"] != "no_photo"]
+
+    def test_rules():
+        cases = [
+            candidate(1.0, 3, 0, "No Photo Item", no_photo=True),
+            candidate(1.0, 0, 0, MARKED_FOR_ARCHIVE_TITLE),
+            candidate(1.0, 4.5, 0, "Great Product"),
+            candidate(1.0, 1.5, 0, "Bad Product"),
+            candidate(1.0, 3.0, 100, "Popular Product"),
+            candidate(1.0, 4.8, 150, MARKED_FOR_ARCHIVE_TITLE, no_photo=True),
+        ]
+        for c in rerank(cases, rules=RuleSet(DEFAULT_RERANKING_RULES)):
+            print(f"{c.title} => similarity: {c.similarity:.3f}")
+
+    def test_no_photo_penalty():
+        rules = RuleSet(DEFAULT_RERANKING_RULES)
+        with_photo = candidate(1.0, 3, 0, "Product")
+        no_photo = candidate(1.0, 3, 0, "Product", no_photo=True)
+        ranked = rerank([no_photo, with_photo], rules=rules)
+        assert [c.id for c in ranked] == [with_photo.id, no_photo.id]
+        assert ranked[1].similarity == ranked[0].similarity - 0.5
+        # The loop scored them the same
+        looped = loop_rerank([candidate(1.0, 3, 0, no_photo=True), candidate(1.0, 3, 0)])
+        assert looped[0].similarity == looped[1].similarity
+        print("The no_photo penalty applies, unlike in the loop reranker")
+
+    def test_parity(trials=200, size=2000, k=100):
+        rng = random.Random(0)
+        loop_rules = RuleSet(LOOP_RULES)
+        rules = RuleSet(DEFAULT_RERANKING_RULES)
+        for _ in range(trials):
+            candidates = [
+                candidate(
+                    similarity=rng.choice([None, 0.5, rng.random()]),
+                    average_rating=rng.choice([None, 0, 2, 4, round(rng.uniform(0, 5), 1)]),
+                    rating_number=rng.choice([None, 0, 30, 31, 200, rng.randint(0, 5000)]),
+                    title=rng.choice([MARKED_FOR_ARCHIVE_TITLE, "", "Product"]),
+                    no_photo=rng.random() < 0.1,
+                )
+                for _ in range(rng.randint(0, size))
+            ]
+            for c in candidates:
+                c.similarity = c.similarity or 0
+            expected = loop_rerank(copy.deepcopy(candidates))
+            actual = rerank(copy.deepcopy(candidates), rules=loop_rules)
+            assert [c.id for c in actual] == [c.id for c in expected]
+            assert [c.similarity for c in actual] == [c.similarity for c in expected]
+
+            # The top k agree on scores; ids may differ only among ties at the cutoff
+            partial = rerank(copy.deepcopy(candidates), k=k, rules=loop_rules)
+            assert [c.similarity for c in partial] == [c.similarity for c in expected[:k]]
+
+            # Stored quality scores give the same scores up to float rounding,
+            # whether all or only some were computed with these rules
+            for c in candidates:
+                c.quality_score, c.quality_score_rules = quality_score(
+                    c.title, [c.first_image_url], c.average_rating, c.rating_number, rules
+                )
+            columns = candidate_columns(candidates)
+            assert np.allclose(rules.score(columns, use_stored=True), rules.score(columns))
+            for c in candidates:
+                if rng.random() < 0.2:
+                    c.quality_score, c.quality_score_rules = 0.0, "stale"
+            columns = candidate_columns(candidates)
+            assert np.allclose(rules.score(columns, use_stored=True), rules.score(columns))
+        print(f"Parity with the loop reranker on {trials} candidate sets")
+
+    test_rules()
+    test_no_photo_penalty()
+    test_parity()
+
+    if RERANKING_RULES_PATH:
+        # Check a rules file before deploying it
+        print(json.dumps(load_rules(RERANKING_RULES_PATH).stats(), indent=2))
@@ -0,0 +1,83 @@
+import argparse
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from app.catalog import bump_catalog_version
+from app.database import SessionLocal
+from app.reranker import candidate_columns, rule_engine
+
+
+def select_batch_sql(stale_only: bool) -> str:
+    # Keyset pagination by id, so each batch is an index range scan
+    stale = "AND (quality_score IS NULL OR quality_score_rules IS DISTINCT FROM :rules_version)"
+    return f"""
+        SELECT id, title, "imageUrls"[1] AS first_image_url, average_rating, rating_number
+        FROM products
+        WHERE id > :after {stale if stale_only else ""}
+        ORDER BY id
+        LIMIT :batch_size
+    """
+
+
+update_batch = text(
+    """
+    UPDATE products
+    SET quality_score = scores.quality_score, quality_score_rules = :rules_version
+    FROM unnest(CAST(:ids AS text[]), CAST(:scores AS float8[])) AS scores (id, quality_score)
+    WHERE products.id = scores.id
+"""
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute products.quality_score with the current reranking rules"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--stale-only",
+        action="store_true",
+        help="only rows without a score from the current rules",
+    )
+    args = parser.parse_args()
+
+    rules = rule_engine.current()
+    print(f"Scoring with {len(rules.compiled)} rules from {rules.source} ({rules.version})")
+    command = text(select_batch_sql(args.stale_only))
+
+    db = SessionLocal()
+    try:
+        after = ""
+        updated = 0
+        start = time.perf_counter()
+        while True:
+            rows = db.execute(
+                command,
+                {"after": after, "batch_size": args.batch_size, "rules_version": rules.version},
+            ).fetchall()
+            if not rows:
+                break
+            candidates = [SimpleNamespace(**row._mapping, similarity=0) for row in rows]
+            scores = rules.quality_scores(candidate_columns(candidates))
+            db.execute(
+                update_batch,
+                {
+                    "ids": [row.id for row in rows],
+                    "scores": scores.tolist(),
+                    "rules_version": rules.version,
+                },
+            )
+            # One transaction per batch, so the backfill can be stopped and resumed
+            bump_catalog_version(db)
+            db.commit()
+            updated += len(rows)
+            after = rows[-1].id
+            print(f"Updated {updated} products ({updated / (time.perf_counter() - start):.0f}/s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
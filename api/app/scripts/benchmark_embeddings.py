@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from app.clip_embedder import EMBEDDING_BACKEND, configure_threads, create_text_encoder
+from app.scripts.embedding_parity import REFERENCE_TEXTS
+
+
+def run_worker(backend, threads, cpus, requests, barrier, results):
+    # Mirrors one uvicorn worker: pinned to its own CPUs, embedding one query at a time
+    settings = configure_threads(
+        backend=backend,
+        intra_op_threads=threads,
+        inter_op_threads=1,
+        cpu_affinity=",".join(str(c) for c in cpus) if cpus else "",
+    )
+    encoder = create_text_encoder(
+        backend,
+        intra_op_threads=settings["intra_op_threads"],
+        inter_op_threads=settings["inter_op_threads"],
+    )
+    encoder.encode(REFERENCE_TEXTS[:1])
+    barrier.wait()
+
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        encoder.encode([REFERENCE_TEXTS[i % len(REFERENCE_TEXTS)]])
+        latencies.append((time.perf_counter() - start) * 1000)
+    results.put(latencies)
+
+
+def run_layout(backend, workers, threads, requests, pin) -> dict:
+    ctx = mp.get_context("spawn")
+    cpus = sorted(os.sched_getaffinity(0))
+    barrier = ctx.Barrier(workers + 1)
+    results = ctx.Queue()
+
+    processes = []
+    for worker in range(workers):
+        worker_cpus = cpus[worker * threads : (worker + 1) * threads] if pin else []
+        process = ctx.Process(
+            target=run_worker,
+            args=(backend, threads, worker_cpus, requests, barrier, results),
+        )
+        process.start()
+        processes.append(process)
+
+    barrier.wait()
+    start = time.perf_counter()
+    latencies = np.concatenate([results.get() for _ in processes])
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+
+    return {
+        "workers": workers,
+        "threads": threads,
+        "throughput": len(latencies) / elapsed,
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep workers x intra-op threads for embed_text on this machine"
+    )
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND)
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--threads", default="1,2,4")
+    parser.add_argument("--requests", type=int, default=200, help="per worker")
+    parser.add_argument("--no-pin", action="store_true", help="don't pin workers to cores")
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0))
+    print(f"{cores} cores, backend {args.backend}")
+    print(f"{'workers':>7} {'threads':>7} {'texts/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        for threads in [int(t) for t in args.threads.split(",")]:
+            pin = not args.no_pin and workers * threads <= cores
+            result = run_layout(args.backend, workers, threads, args.requests, pin)
+            print(
+                f"{result['workers']:>7} {result['threads']:>7} "
+                f"{result['throughput']:>9.1f} {result['p50']:>8.2f} {result['p99']:>8.2f}"
+                + ("" if pin else "  (unpinned)")
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from app.clip_embedder import EMBEDDING_BACKENDS, create_text_encoder
+
+# Mix of raw queries and the formatted strings SearchService embeds
+REFERENCE_TEXTS = [
+    "brown boots",
+    "stilettos",
+    "black leather ankle boots",
+    "I need a cute dress for the summer",
+    "linen pants men",
+    "minimalist black crossbody bag for summer travel",
+    "a very very unrelated sentence about a comedian",
+    "{'gender': ['women'], 'colors': ['UNKNOWN'], 'category': ['dress'], 'styles': ['summer', 'cute']}",
+    "{'gender': ['men'], 'colors': ['UNKNOWN'], 'category': ['sneakers'], 'styles': ['red']}",
+    "{'gender': ['UNKNOWN'], 'colors': ['UNKNOWN'], 'category': ['jeans'], 'styles': ['high waist', 'flared']}",
+    "{'gender': ['women'], 'colors': ['UNKNOWN'], 'category': ['sandals', 'heels'], 'styles': ['UNKNOWN']}",
+    "{'gender': ['UNKNOWN'], 'colors': ['UNKNOWN'], 'category': ['UNKNOWN'], 'styles': ['UNKNOWN']}",
+]
+
+# Below this cosine agreement a backend shouldn't serve queries against
+# embeddings that were written with the torch backend
+MIN_COSINE = 0.99
+
+
+def time_per_text(encoder, texts, repeats: int = 5) -> float:
+    """Mean milliseconds to encode one text at a time, the search path's shape."""
+    encoder.encode(texts[:1])  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            encoder.encode([text])
+    return (time.perf_counter() - start) * 1000 / (repeats * len(texts))
+
+
+def run_parity(backends: list[str]):
+    reference_encoder = create_text_encoder("torch")
+    reference = reference_encoder.encode(REFERENCE_TEXTS)
+    print(f"torch: {time_per_text(reference_encoder, REFERENCE_TEXTS):.2f} ms/text")
+
+    for backend in backends:
+        encoder = create_text_encoder(backend)
+        embeddings = encoder.encode(REFERENCE_TEXTS)
+        # Both sides are L2 normalized, so the row-wise dot product is the cosine
+        cosines = np.sum(reference * embeddings, axis=1)
+        worst = int(np.argmin(cosines))
+        print(
+            f"{backend}: {time_per_text(encoder, REFERENCE_TEXTS):.2f} ms/text, "
+            f"cosine mean {cosines.mean():.4f} min {cosines.min():.4f} "
+            f"({'ok' if cosines.min() >= MIN_COSINE else 'FAIL'}), "
+            f"worst: {REFERENCE_TEXTS[worst][:60]!r}"
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    backends = sys.argv[1:] or [b for b in EMBEDDING_BACKENDS if b != "torch"]
+    run_parity(backends)
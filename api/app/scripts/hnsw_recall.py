@@ -0,0 +1,171 @@
+import argparse
+import json
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app.database import SessionLocal
+from app.models import LIVE_EMBEDDED_PRODUCTS
+from app.search import EMBEDDINGS_SEARCH_LIMIT, SEARCH_PROFILES
+
+# Copy of the live, embedded products that candidate indexes are built on
+SCRATCH_TABLE = "hnsw_recall_products"
+
+
+def nearest_sql(table: str, exact: bool = False) -> str:
+    distance = "embedding <=> CAST(:embedding AS vector)"
+    if exact:
+        # Same trick as SearchService's exact profile: no index, full scan
+        distance = f"({distance}) + 0"
+    return f"""
+        SELECT id FROM {table}
+        WHERE {LIVE_EMBEDDED_PRODUCTS}
+        ORDER BY {distance}
+        LIMIT {EMBEDDINGS_SEARCH_LIMIT}
+    """
+
+
+def sample_queries(db, n: int) -> list[str]:
+    # Embeddings of random live products, kept in pgvector's text format
+    rows = db.execute(
+        text(
+            f"""
+            SELECT embedding::text AS embedding FROM products
+            WHERE {LIVE_EMBEDDED_PRODUCTS}
+            ORDER BY random()
+            LIMIT :n
+            """
+        ),
+        {"n": n},
+    ).fetchall()
+    return [row.embedding for row in rows]
+
+
+def query_plan(db, table: str, embedding: str) -> str:
+    """Names the index the ANN query uses, or the scan type if it uses none."""
+    plan = db.execute(
+        text(f"EXPLAIN (FORMAT JSON) {nearest_sql(table)}"), {"embedding": embedding}
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            return f"{node['Node Type']} using {node['Index Name']}"
+        nodes.extend(node.get("Plans", []))
+    return "no index used (sequential scan)"
+
+
+def build_scratch_index(db, m: int, ef_construction: int) -> float:
+    db.execute(text(f"DROP INDEX IF EXISTS {SCRATCH_TABLE}_hnsw_idx"))
+    start = time.perf_counter()
+    db.execute(
+        text(
+            f"""
+            CREATE INDEX {SCRATCH_TABLE}_hnsw_idx ON {SCRATCH_TABLE}
+            USING hnsw (embedding vector_cosine_ops)
+            WITH (m = {int(m)}, ef_construction = {int(ef_construction)})
+            WHERE {LIVE_EMBEDDED_PRODUCTS}
+            """
+        )
+    )
+    db.execute(text(f"ANALYZE {SCRATCH_TABLE}"))
+    return time.perf_counter() - start
+
+
+def measure(db, table: str, queries: list[str], truth: list[set], ef_search: int) -> dict:
+    db.execute(
+        text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+        {"ef_search": str(ef_search)},
+    )
+    command = text(nearest_sql(table))
+    recalls = []
+    latencies = []
+    for embedding, expected in zip(queries, truth):
+        start = time.perf_counter()
+        ids = {row.id for row in db.execute(command, {"embedding": embedding})}
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(ids & expected) / len(expected) if expected else 1.0)
+    return {
+        "recall": float(np.mean(recalls)),
+        "mean_ms": float(np.mean(latencies)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"ANN recall@{EMBEDDINGS_SEARCH_LIMIT} against exact ranking per HNSW setting"
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument(
+        "--ef-search",
+        default=",".join(
+            str(p["ef_search"]) for p in SEARCH_PROFILES.values() if p["ef_search"]
+        ) + ",400",
+    )
+    parser.add_argument(
+        "--index-params",
+        default="",
+        help="m:ef_construction pairs to build on a scratch copy, e.g. 16:64,16:200,32:400. "
+        "Without this the production index is measured.",
+    )
+    args = parser.parse_args()
+    ef_searches = [int(ef) for ef in args.ef_search.split(",")]
+
+    # Everything runs in one transaction that's rolled back at the end
+    db = SessionLocal()
+    try:
+        queries = sample_queries(db, args.queries)
+        if not queries:
+            print("No embedded products to sample queries from")
+            return
+        print(f"{len(queries)} sampled queries")
+
+        if args.index_params:
+            db.execute(
+                text(
+                    f"""
+                    CREATE TEMP TABLE {SCRATCH_TABLE} ON COMMIT DROP AS
+                    SELECT id, embedding, "deletedAt" FROM products
+                    WHERE {LIVE_EMBEDDED_PRODUCTS}
+                    """
+                )
+            )
+            table = SCRATCH_TABLE
+            builds = [tuple(int(v) for v in p.split(":")) for p in args.index_params.split(",")]
+        else:
+            table = "products"
+            builds = [None]
+
+        exact = text(nearest_sql(table, exact=True))
+        truth = [
+            {row.id for row in db.execute(exact, {"embedding": embedding})}
+            for embedding in queries
+        ]
+
+        print(f"{'index':>22} {'ef_search':>9} {'recall':>7} {'mean ms':>8} {'p99 ms':>8}")
+        for build in builds:
+            if build is None:
+                label = "production"
+            else:
+                m, ef_construction = build
+                seconds = build_scratch_index(db, m, ef_construction)
+                label = f"m={m},ef_c={ef_construction}"
+                print(f"built {label} in {seconds:.1f}s")
+            print(f"plan: {query_plan(db, table, queries[0])}")
+            for ef_search in ef_searches:
+                result = measure(db, table, queries, truth, ef_search)
+                print(
+                    f"{label:>22} {ef_search:>9} {result['recall']:>7.3f} "
+                    f"{result['mean_ms']:>8.2f} {result['p99_ms']:>8.2f}"
+                )
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
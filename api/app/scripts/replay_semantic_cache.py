@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.clip_embedder import embed_query_async
+from app.database import AsyncSessionLocal
+from app.parse_query import normalize_query
+from app.search import DEFAULT_SEARCH_PROFILE, SearchService, semantic_cache_scope
+from app.semantic_cache import SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SemanticCache
+
+
+def load_log(path: str, limit: int) -> list[dict]:
+    """Reads one search request body per line: {"q", "user_preferences", "profile"}."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            preferences = entry.get("user_preferences") or {}
+            entries.append(
+                {
+                    "q": entry.get("q") or entry["query"],
+                    "user_preferences": SimpleNamespace(
+                        gender=preferences.get("gender"), styles=preferences.get("styles")
+                    ),
+                    "profile": entry.get("profile") or DEFAULT_SEARCH_PROFILE,
+                }
+            )
+            if limit and len(entries) == limit:
+                break
+    return entries
+
+
+async def replay_one(entry: dict, db) -> dict:
+    # Same steps as SearchService._search_parsed, without any result caching
+    service = SearchService(entry["user_preferences"], entry["profile"])
+    parsed = await service._parse(entry["q"])
+    keywords = parsed.get("category", []) + parsed.get("tags", [])
+    formatted_query = service._format_query(service._add_user_preferences(parsed))
+    embedding = await embed_query_async(formatted_query)
+    ranked = await service._retrieve_and_rank(formatted_query, embedding, keywords, db)
+    return {
+        # The catalog version is fixed for the replay
+        "scope": semantic_cache_scope(
+            None, service.rules.version, entry["profile"], entry["user_preferences"]
+        ),
+        "formatted_query": formatted_query,
+        "embedding": embedding,
+        "ids": [c.id for c in ranked],
+    }
+
+
+def overlap(expected: list[str], served: list[str], k: int) -> float:
+    expected = expected[:k]
+    return len(set(expected) & set(served[:k])) / len(expected) if expected else 1.0
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a query log through the semantic cache: hit rate and overlap of reused results"
+    )
+    parser.add_argument("log", help="JSONL file with one search request body per line")
+    parser.add_argument(
+        "--thresholds",
+        default=",".join(str(t) for t in sorted({0.9, 0.95, SEMANTIC_CACHE_THRESHOLD, 0.99})),
+    )
+    parser.add_argument("--size", type=int, default=SEMANTIC_CACHE_SIZE)
+    parser.add_argument("--k", type=int, default=10, help="compare the top k results of hits")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first n queries")
+    parser.add_argument("--examples", type=int, default=5, help="worst hits to print per threshold")
+    args = parser.parse_args()
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+
+    entries = load_log(args.log, args.limit)
+    print(f"Replaying {len(entries)} queries")
+    # Log order matters, the cache only knows the queries before each one
+    results = []
+    async with AsyncSessionLocal() as db:
+        for entry in entries:
+            results.append(await replay_one(entry, db))
+            await db.rollback()
+
+    # Baseline: the exact result cache, keyed on the normalized query
+    seen = set()
+    exact_hits = 0
+    for entry, result in zip(entries, results):
+        key = (result["scope"], normalize_query(entry["q"]))
+        exact_hits += key in seen
+        seen.add(key)
+    print(f"exact result cache hit rate {exact_hits / len(entries):.3f}")
+
+    print(
+        f"{'threshold':>9} {'hit rate':>8} {'new hits':>8} "
+        f"{'overlap@' + str(args.k):>10} {'min':>6} {'identical':>9}"
+    )
+    for threshold in thresholds:
+        cache = SemanticCache(maxsize=args.size, threshold=threshold)
+        hits = []
+        for entry, result in zip(entries, results):
+            served = cache.get(result["scope"], result["embedding"])
+            if served is None:
+                cache.set(result["scope"], result["embedding"], (entry["q"], result))
+                continue
+            served_q, served_result = served
+            hits.append(
+                {
+                    "q": entry["q"],
+                    "served_q": served_q,
+                    # Whether the exact result cache would have missed it
+                    "new": normalize_query(served_q) != normalize_query(entry["q"]),
+                    "overlap": overlap(result["ids"], served_result["ids"], args.k),
+                    "identical": served_result["ids"] == result["ids"],
+                }
+            )
+
+        overlaps = [h["overlap"] for h in hits]
+        print(
+            f"{threshold:>9.3f} {len(hits) / len(entries):>8.3f} "
+            f"{sum(h['new'] for h in hits) / len(entries):>8.3f} "
+            f"{np.mean(overlaps) if hits else float('nan'):>10.3f} "
+            f"{min(overlaps) if hits else float('nan'):>6.3f} "
+            f"{np.mean([h['identical'] for h in hits]) if hits else float('nan'):>9.3f}"
+        )
+        for hit in sorted(hits, key=lambda h: h["overlap"])[: args.examples]:
+            if hit["overlap"] < 1:
+                print(f"    {hit['overlap']:.2f}  {hit['q']!r} served {hit['served_q']!r}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,9 +1,11 @@
 import pandas as pd
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert
-from .database import SessionLocal
-from .models import Product
-from .clip_embedder import embed_text
+from ..catalog import bump_catalog_version
+from ..database import SessionLocal
+from ..models import Product
+from ..clip_embedder import embed_text
+from ..reranker import quality_score
 from dotenv import load_dotenv
 
 from transformers import AutoTokenizer, AutoModel
@@ -37,6 +39,7 @@ def load_products(
         if rating_number:
             rating_number = int(rating_number)
         store = item.get("store")
+        score, rules_version = quality_score(title, image_urls, average_rating, rating_number)
 
         stmt = (
             insert(Product)
@@ -49,6 +52,8 @@ def load_products(
                 average_rating=average_rating,
                 rating_number=rating_number,
                 store=store,
+                quality_score=score,
+                quality_score_rules=rules_version,
             )
             .on_conflict_do_update(
                 index_elements=["id"],
@@ -60,6 +65,8 @@ def load_products(
                     "average_rating": average_rating,
                     "rating_number": rating_number,
                     "store": store,
+                    "quality_score": score,
+                    "quality_score_rules": rules_version,
                 },
             )
         )
@@ -68,11 +75,13 @@ def load_products(
         batch_count += 1
 
         if batch_count >= batch_size:
+            bump_catalog_version(db)
             db.commit()
             batch_count = 0
             print(f"Committed batch ending at row {i}")
 
     if batch_count > 0:
+        bump_catalog_version(db)
         db.commit()
         print(f"Final commit for remaining {batch_count} products.")
 
@@ -1,9 +1,10 @@
 import pandas as pd
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert
-from .database import SessionLocal
-from .models import Product
-from .clip_embedder import embed_text
+from ..catalog import bump_catalog_version
+from ..database import SessionLocal
+from ..models import Product
+from ..clip_embedder import embed_text
 from dotenv import load_dotenv
 
 import json
@@ -71,6 +72,7 @@ def load_embeddings(
                     .values(embedding=embedding)
                 )
 
+        bump_catalog_version(db)
         db.commit()
         print(f"Committed batch: {i} → {i + len(batch_df) - 1}")
         i += batch_size
@@ -1,29 +1,33 @@
-from app.parse_query import parse_query
-from app.clip_embedder import embed_text
+from app.cache import TTLCache
+from app.catalog import catalog_version
+from app.parse_query import (
+    normalize_query,
+    parse_query,
+    parse_query_with_llm,
+    parse_query_without_llm,
+)
+from app.clip_embedder import embed_query_async, embed_text
+from app.database import AsyncSessionLocal, async_engine
+from app.models import LIVE_EMBEDDED_PRODUCTS, LIVE_PRODUCTS
+from app.semantic_cache import SEMANTIC_CACHE_ENABLED, semantic_cache
+from app.reranker import DEFAULT_RERANKING_RULES, RuleSet, rerank, rule_engine
 from app.schemas import Product as ProductSchema
-from sqlalchemy import text
+from pgvector import Vector
+from pgvector.asyncpg import register_vector
+from sqlalchemy import event, text
 from collections import defaultdict
-RERANKING_CONFIG = {
-    "no_photo": {"weight": -0.5},
-    "marked_for_archive": {"weight": -1},
-    "high_average_rating": {
-        "threshold": 4,
-        "normalization_constant": 5,
-        "weight": 0.5,
-    },
-    "low_average_rating": {
-        "threshold": 2,
-        "normalization_constant": 2,
-        "weight": -0.5,
-    },
-    "high_rating_number": {
-        "threshold": 30,
-        "ceiling": 200,
-        "normalization_constant": 200,
-        "weight": 0.2,
-    },
-}
-
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Optional
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import time
+
+logger = logging.getLogger(__name__)
 MAX_KEYWORDS = 2
 
 EMPTY_TOKEN = "UNKNOWN"
@@ -31,41 +35,703 @@ EMPTY_TOKEN = "UNKNOWN"
 EMBEDDINGS_MATCH_WEIGHT = 1
 TITLE_MATCH_WEIGHT = 0.5
 
+# Candidates kept after reranking (0 keeps all). Only these are sorted, and
+# they are the most a search can page through.
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "200"))
+
+# Run the embeddings and title retrievers concurrently, each on its own session
+PARALLEL_RETRIEVAL = os.getenv("PARALLEL_RETRIEVAL", "true").lower() == "true"
+# Threads for the blocking query parse (LLM call), off the event loop
+RETRIEVAL_MAX_WORKERS = int(os.getenv("RETRIEVAL_MAX_WORKERS", "32"))
+
+# Probe the vector index with the raw query while the LLM parse is in flight,
+# and fall back to those results if the parse is slow or fails
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+PARSE_TIMEOUT_SECONDS = float(os.getenv("PARSE_TIMEOUT_SECONDS", "3"))
+
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval"
+)
+
+EMBEDDINGS_SEARCH_LIMIT = 100
+
+# Recall/latency trade-offs for the HNSW index. ef_search is the candidate list
+# size and must be >= EMBEDDINGS_SEARCH_LIMIT to get a full page of results
+# (pgvector's default of 40 is not). "exact" skips the index for a full scan.
+# Measure recall per profile with app.scripts.hnsw_recall.
+SEARCH_PROFILES = {
+    "fast": {"ef_search": 100},
+    "balanced": {"ef_search": 200},
+    "exact": {"ef_search": None},
+}
+DEFAULT_SEARCH_PROFILE = os.getenv("SEARCH_PROFILE", "balanced")
+if DEFAULT_SEARCH_PROFILE not in SEARCH_PROFILES:
+    raise ValueError(
+        f"Unknown SEARCH_PROFILE {DEFAULT_SEARCH_PROFILE!r}, expected one of {list(SEARCH_PROFILES)}"
+    )
+
+
+@dataclass(slots=True)
+class Candidate:
+    """A retrieved product with just the columns reranking needs."""
+
+    id: str
+    similarity: float
+    title: str
+    first_image_url: Optional[str]
+    average_rating: Optional[float]
+    rating_number: Optional[int]
+    quality_score: Optional[float]
+    quality_score_rules: Optional[str]
+
+
+# Selected by the retrievers; full rows are only fetched for returned products
+CANDIDATE_COLUMNS = 'title, "imageUrls"[1] AS first_image_url, average_rating, rating_number, quality_score, quality_score_rules'
+
+
+def embeddings_search_sql(embedding: str, exact: bool = False) -> str:
+    """Nearest live products to the vector parameter named by embedding.
+
+    The vector is sent once, in pgvector's binary format, and the ORDER BY
+    reuses the computed distance. The WHERE clause matches the partial HNSW
+    index's predicate.
+    """
+    distance = f"embedding <=> {embedding}"
+    if exact:
+        # Hides the operator from the planner so it can't use the ANN index
+        distance = f"({distance}) + 0"
+    return f"""
+        SELECT id, 1 - distance AS similarity, title, first_image_url, average_rating, rating_number, quality_score, quality_score_rules
+        FROM (
+            SELECT id, {distance} AS distance, {CANDIDATE_COLUMNS} FROM products
+            WHERE {LIVE_EMBEDDED_PRODUCTS}
+            ORDER BY distance
+            LIMIT {EMBEDDINGS_SEARCH_LIMIT}
+        ) AS nearest
+        ORDER BY distance
+    """
+
+
+# asyncpg prepares each statement once per connection and caches it (see
+# DB_STATEMENT_CACHE_SIZE), so these are parsed and planned once, not per search
+embeddings_search_query = text(embeddings_search_sql(":embedding"))
+exact_embeddings_search_query = text(embeddings_search_sql(":embedding", exact=True))
+set_ef_search = text("SELECT set_config('hnsw.ef_search', :ef_search, true)")
+
+TITLE_SEARCH_LIMIT = 100
+
+# pg_trgm word similarity distance, 1 - word_similarity(:keywords, title). Same
+# as :keywords <<-> title, but only the title-first form can walk the GiST
+# index in distance order, so common keywords stop after TITLE_SEARCH_LIMIT
+# matches instead of scoring every title that contains them
+TITLE_DISTANCE = "title <->> {keywords}"
+
+
+def title_search_sql(keyword_count: int) -> str:
+    """Live products whose title contains every keyword, best matches first.
+
+    Keywords are bound as :keyword_0.. ILIKE patterns and ranked by pg_trgm
+    word similarity to the joined :keywords, both served by the trigram indexes.
+    """
+    distance = TITLE_DISTANCE.format(keywords=":keywords")
+    keywords_match_str = " AND ".join(
+        f"title ILIKE :keyword_{i}" for i in range(keyword_count)
+    )
+    return f"""
+        SELECT id, 1 - ({distance}) AS similarity, {CANDIDATE_COLUMNS} FROM products
+        WHERE {keywords_match_str} AND {LIVE_PRODUCTS}
+        ORDER BY {distance}
+        LIMIT {TITLE_SEARCH_LIMIT}
+    """
+
+
+title_search_queries = {
+    count: text(title_search_sql(count)) for count in range(1, MAX_KEYWORDS + 1)
+}
+
+
+# Fuse both retrievers in one statement and only ship the top candidates back.
+# Scores are the same weighted sum as _merge_results.
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "false").lower() == "true"
+HYBRID_TOP_K = int(
+    os.getenv("HYBRID_TOP_K", str(EMBEDDINGS_SEARCH_LIMIT + TITLE_SEARCH_LIMIT))
+)
+
+
+def hybrid_search_sql(keyword_count: int, exact: bool = False) -> str:
+    """Top :top_k candidates fused from the vector and title branches.
+
+    Ranked by fused score plus the stored quality score where it was computed
+    with the current rules (:rules_version), the reranker's order when stored
+    scores are used, so a small top_k drops the lowest ranked.
+    """
+    distance = "embedding <=> :embedding"
+    if exact:
+        distance = f"({distance}) + 0"
+    branches = [
+        f"""
+            SELECT id, (1 - distance) * :embeddings_weight AS score FROM (
+                SELECT id, {distance} AS distance FROM products
+                WHERE {LIVE_EMBEDDED_PRODUCTS}
+                ORDER BY distance
+                LIMIT {EMBEDDINGS_SEARCH_LIMIT}
+            ) AS vector_candidates
+        """
+    ]
+    if keyword_count:
+        keywords_match_str = " AND ".join(
+            f"title ILIKE :keyword_{i}" for i in range(keyword_count)
+        )
+        title_distance = TITLE_DISTANCE.format(keywords=":keywords")
+        branches.append(
+            f"""
+            SELECT id, similarity * :title_weight AS score FROM (
+                SELECT id, 1 - ({title_distance}) AS similarity FROM products
+                WHERE {keywords_match_str} AND {LIVE_PRODUCTS}
+                ORDER BY {title_distance}
+                LIMIT {TITLE_SEARCH_LIMIT}
+            ) AS title_candidates
+        """
+        )
+    return f"""
+        SELECT fused.id, fused.similarity, {CANDIDATE_COLUMNS}
+        FROM (
+            SELECT id, SUM(score) AS similarity
+            FROM ({" UNION ALL ".join(branches)}) AS candidates
+            GROUP BY id
+        ) AS fused
+        JOIN products USING (id)
+        ORDER BY fused.similarity
+            + CASE WHEN quality_score_rules = :rules_version THEN quality_score ELSE 0 END DESC
+        LIMIT :top_k
+    """
+
+
+hybrid_search_queries = {
+    (count, exact): text(hybrid_search_sql(count, exact))
+    for count in range(MAX_KEYWORDS + 1)
+    for exact in (False, True)
+}
+
+# Batch search runs each retriever once for all queries: the per-query
+# statement runs in a LATERAL join over the unnested query parameters, and
+# rows carry the query's position (ord, from 1)
+BATCH_SEARCH_MAX_QUERIES = int(os.getenv("BATCH_SEARCH_MAX_QUERIES", "1000"))
+
+
+def batch_embeddings_search_sql(exact: bool = False) -> str:
+    """Nearest live products to each vector in :embeddings, per the HNSW index."""
+    distance = "embedding <=> queries.embedding"
+    if exact:
+        distance = f"({distance}) + 0"
+    return f"""
+        SELECT queries.ord, nearest.id, 1 - nearest.distance AS similarity, nearest.title, nearest.first_image_url, nearest.average_rating, nearest.rating_number, nearest.quality_score, nearest.quality_score_rules
+        FROM unnest(CAST(:embeddings AS vector[])) WITH ORDINALITY AS queries (embedding, ord)
+        CROSS JOIN LATERAL (
+            SELECT id, {distance} AS distance, {CANDIDATE_COLUMNS} FROM products
+            WHERE {LIVE_EMBEDDED_PRODUCTS}
+            ORDER BY distance
+            LIMIT {EMBEDDINGS_SEARCH_LIMIT}
+        ) AS nearest
+    """
+
+
+def batch_title_search_sql() -> str:
+    """title_search_sql for each query in :ords, whose unused keyword slots are NULL."""
+    keyword_columns = ", ".join(f"keyword_{i}" for i in range(MAX_KEYWORDS))
+    keyword_arrays = ", ".join(
+        f"CAST(:keyword_{i} AS text[])" for i in range(MAX_KEYWORDS)
+    )
+    keywords_match_str = " AND ".join(
+        ["title ILIKE queries.keyword_0"]
+        + [
+            f"(queries.keyword_{i} IS NULL OR title ILIKE queries.keyword_{i})"
+            for i in range(1, MAX_KEYWORDS)
+        ]
+    )
+    distance = TITLE_DISTANCE.format(keywords="queries.keywords")
+    return f"""
+        SELECT queries.ord, matches.id, matches.similarity, matches.title, matches.first_image_url, matches.average_rating, matches.rating_number, matches.quality_score, matches.quality_score_rules
+        FROM unnest(CAST(:ords AS int[]), CAST(:keywords AS text[]), {keyword_arrays})
+            AS queries (ord, keywords, {keyword_columns})
+        CROSS JOIN LATERAL (
+            SELECT id, 1 - ({distance}) AS similarity, {CANDIDATE_COLUMNS} FROM products
+            WHERE {keywords_match_str} AND {LIVE_PRODUCTS}
+            ORDER BY {distance}
+            LIMIT {TITLE_SEARCH_LIMIT}
+        ) AS matches
+    """
+
+
+batch_embeddings_search_queries = {
+    exact: text(batch_embeddings_search_sql(exact)) for exact in (False, True)
+}
+batch_title_search_query = text(batch_title_search_sql())
+
+hydrate_products_query = text(
+    """
+    SELECT id, title, "imageUrls", average_rating, rating_number, store, "createdAt", "modifiedAt", "deletedAt", description FROM products
+    WHERE id = ANY(:ids)
+"""
+)
+
+
+# Ranked candidates of searches that have more pages, so later pages are sliced
+# from memory instead of re-running the parse, embedding and retrieval. Only the
+# issuing worker has them; elsewhere, or once expired, the ranking is rebuilt.
+SEARCH_CURSOR_CACHE_SIZE = int(os.getenv("SEARCH_CURSOR_CACHE_SIZE", "1024"))
+SEARCH_CURSOR_TTL_SECONDS = float(os.getenv("SEARCH_CURSOR_TTL_SECONDS", "600"))
+ranking_cache = TTLCache(maxsize=SEARCH_CURSOR_CACHE_SIZE, ttl=SEARCH_CURSOR_TTL_SECONDS)
+
+
+# Products in the provisional page of a streamed search without a limit
+STREAM_PROVISIONAL_SIZE = int(os.getenv("STREAM_PROVISIONAL_SIZE", "20"))
+
+
+# Final rankings per (query, preferences) and product rows, both keyed on the
+# catalog version so any catalog write invalidates them (after at most
+# CATALOG_VERSION_POLL_SECONDS). Repeat searches then skip the parse,
+# embedding and database entirely.
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "3600"))
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "50000"))
+result_cache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL_SECONDS)
+product_cache = TTLCache(maxsize=PRODUCT_CACHE_SIZE, ttl=RESULT_CACHE_TTL_SECONDS)
+
+
+def preferences_key(user_preferences) -> tuple:
+    # Only the preferences that change the ranking
+    gender = styles = None
+    if user_preferences:
+        gender = user_preferences.gender.lower() if user_preferences.gender else None
+        styles = tuple(user_preferences.styles) if user_preferences.styles else None
+    return (gender, styles)
+
+
+def result_cache_key(
+    version: int, rules_version: str, search_profile: str, q: str, user_preferences
+) -> tuple:
+    # The rules version too, so a reloaded rules file doesn't serve old rankings
+    return (
+        version,
+        rules_version,
+        search_profile,
+        normalize_query(q),
+        *preferences_key(user_preferences),
+    )
+
+
+def semantic_cache_scope(
+    version: int, rules_version: str, search_profile: str, user_preferences
+) -> tuple:
+    # Only queries ranked against the same catalog, rules and preferences match
+    return (version, rules_version, search_profile, *preferences_key(user_preferences))
+
+
+def cursor_fingerprint(q: str, search_profile: str, user_preferences) -> str:
+    # What the ranking depends on, so any worker can check a cursor belongs to the request
+    key = repr((q, search_profile, preferences_key(user_preferences)))
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+class InvalidCursor(ValueError):
+    """The cursor is malformed or was issued for another query."""
+
+
+def like_pattern(keyword: str) -> str:
+    # Match the keyword literally, even if it contains LIKE wildcards
+    escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def configure_search_connection(dbapi_connection, connection_record):
+    # Embeddings are bound as lists and sent with pgvector's binary codec
+    dbapi_connection.run_async(register_vector)
+
+    # Session default, so searches with the default profile need no SET
+    ef_search = SEARCH_PROFILES[DEFAULT_SEARCH_PROFILE]["ef_search"]
+    dbapi_connection.run_async(
+        lambda conn: conn.execute(
+            f"SELECT set_config('hnsw.ef_search', '{ef_search or 40}', false)"
+        )
+    )
+    connection_record.info["hnsw.ef_search"] = ef_search
+
 
 class SearchService:
-    def __init__(self, user_preferences: dict):
+    def __init__(self, user_preferences: dict, search_profile: str = DEFAULT_SEARCH_PROFILE):
         self.user_preferences = user_preferences
+        self.search_profile = search_profile
+        # Stage name -> duration in milliseconds for the last search
+        self.timings = {}
+        # Cursor for the page after the last one returned, if there is one
+        self.next_cursor = None
+        # Set by stream_products, resolved with the first vector search results
+        self.provisional = None
+        # Read once per search, see app.catalog
+        self.catalog_version = None
+        # Reranking rules, also read once per search so a reload mid-search
+        # can't rank with one version and cache under another
+        self.rules = rule_engine.current()
+        # Whether the results came from the speculative probe, not the parsed query
+        self.fell_back = False
+
+    async def search_products(self, q: str, db, limit: Optional[int] = None, cursor: Optional[str] = None):
+        fingerprint = cursor_fingerprint(q, self.search_profile, self.user_preferences)
+        if cursor:
+            token, offset, ranked = self._load_cursor(cursor, fingerprint)
+            if ranked is None:
+                # Issued by another worker or expired: rank again (usually a
+                # result cache hit) and carry on from the same offset
+                token, ranked = None, await self._cached_rank(q, db)
+        else:
+            token, offset, ranked = None, 0, await self._cached_rank(q, db)
+
+        end = len(ranked) if limit is None else offset + limit
+        if end < len(ranked):
+            if token is None:
+                token = secrets.token_urlsafe(12)
+                ranking_cache.set(token, (fingerprint, ranked))
+            self.next_cursor = f"{token}.{fingerprint}.{end}"
+
+        # Full rows only for the products actually returned
+        products = await self._timed_async("hydrate", self._hydrate(ranked[offset:end], db))
+        logger.debug("Hydrated %d products", len(products))
+        return products
+
+    async def stream_products(self, q: str, db, limit: Optional[int] = None):
+        """Yields a provisional page as soon as a vector search returns, then the final one.
 
-    def search_products(self, q: str, db):
-        # Parse categories and relevant tags from query
-        parsed = parse_query(q)
-        print("Parsed query", parsed)
+        The provisional page is the vector candidates alone, reranked; it's
+        skipped if the full search finishes first (e.g. with HYBRID_RETRIEVAL,
+        which has no separate vector branch).
+        """
+        self.provisional = asyncio.get_running_loop().create_future()
+        search = asyncio.create_task(self.search_products(q, db, limit=limit))
+        try:
+            await asyncio.wait({search, self.provisional}, return_when=asyncio.FIRST_COMPLETED)
+            if self.provisional.done() and not search.done():
+                # Copies, since the full search still merges and reranks these
+                candidates = [replace(c) for c in self.provisional.result()]
+                top = rerank(candidates, k=limit or STREAM_PROVISIONAL_SIZE)
+                # The request session belongs to the running search
+                products = await self._timed_async(
+                    "provisional", self._with_session(self._hydrate, top)
+                )
+                yield {"type": "provisional", "products": products}
+
+            products = await search
+            yield {
+                "type": "final",
+                "products": products,
+                "next_cursor": self.next_cursor,
+                "timings": self.timings,
+            }
+        finally:
+            # The client went away before the search finished
+            search.cancel()
+
+    async def search_batch(self, queries: list, db, limit: Optional[int] = None):
+        """Results for each (q, user_preferences) pair, searched together.
+
+        Queries are parsed concurrently, embedded in one embed_text call, and
+        each retriever runs as one grouped statement for all of them.
+        """
+        parsed_queries = await self._timed_async(
+            "parse",
+            asyncio.gather(*(self._parse(q) for q, _ in queries), return_exceptions=True),
+        )
+
+        keywords, formatted_queries = [], []
+        for (q, user_preferences), parsed in zip(queries, parsed_queries):
+            if isinstance(parsed, Exception):
+                # Same fallback as the speculative probe: the raw query
+                logger.warning("Error parsing batch query %r: %r", q, parsed)
+                parsed = {"category": [q.lower().strip()]}
+            keywords.append((parsed.get("category", []) + parsed.get("tags", []))[:MAX_KEYWORDS])
+            service = SearchService(user_preferences, self.search_profile)
+            formatted_queries.append(service._format_query(service._add_user_preferences(parsed)))
+
+        embeddings = await self._timed_async(
+            "embed", asyncio.to_thread(embed_text, formatted_queries)
+        )
+        embeddings_products = await self._timed_async(
+            "embeddings_search", self._batch_embeddings_search(embeddings, db)
+        )
+        title_products = await self._timed_async(
+            "title_search", self._batch_title_search(keywords, db)
+        )
+
+        start = time.perf_counter()
+        pages = []
+        for embeddings_candidates, title_candidates in zip(embeddings_products, title_products):
+            ranked = self._rerank_products(self._merge_results(embeddings_candidates, title_candidates))
+            pages.append(ranked if limit is None else ranked[:limit])
+        self.timings["rerank"] = (time.perf_counter() - start) * 1000
+        logger.debug("Ranked %d batch queries", len(pages))
+
+        return await self._timed_async("hydrate", self._hydrate_pages(pages, db))
+
+    async def _batch_embeddings_search(self, embeddings, db):
+        exact = await self._apply_search_profile(db)
+        result = await db.execute(
+            batch_embeddings_search_queries[exact],
+            {"embeddings": [Vector(embedding) for embedding in embeddings]},
+        )
+        products = [[] for _ in embeddings]
+        for row in result:
+            # Columns after ord are in Candidate's field order
+            products[row.ord - 1].append(Candidate(*row[1:]))
+        return products
+
+    async def _batch_title_search(self, keywords: list[list[str]], db):
+        products = [[] for _ in keywords]
+        searched = [(i, k) for i, k in enumerate(keywords) if k]
+        if not searched:
+            return products
+        params = {
+            "ords": [i + 1 for i, _ in searched],
+            "keywords": [" ".join(k) for _, k in searched],
+        }
+        for slot in range(MAX_KEYWORDS):
+            params[f"keyword_{slot}"] = [
+                like_pattern(k[slot]) if slot < len(k) else None for _, k in searched
+            ]
+        try:
+            result = await db.execute(batch_title_search_query, params)
+        except Exception:
+            logger.exception("Error in batch title search")
+            await db.rollback()
+            return products
+        for row in result:
+            products[row.ord - 1].append(Candidate(*row[1:]))
+        return products
+
+    def _load_cursor(self, cursor: str, fingerprint: str):
+        """Returns the token, offset and cached ranking, which is None if this worker has none."""
+        try:
+            token, issued_for, offset = cursor.split(".")
+            offset = int(offset)
+        except ValueError:
+            raise InvalidCursor("Malformed cursor")
+        if offset < 0:
+            raise InvalidCursor("Malformed cursor")
+        if issued_for != fingerprint:
+            raise InvalidCursor("Cursor was issued for a different query")
+        entry = ranking_cache.get(token)
+        if entry is None:
+            return token, offset, None
+        return token, offset, entry[1]
+
+    async def _cached_rank(self, q: str, db):
+        version = await self._catalog_version(db)
+        if not RESULT_CACHE_ENABLED or version is None:
+            return await self._rank(q, db)
+
+        key = result_cache_key(
+            version, self.rules.version, self.search_profile, q, self.user_preferences
+        )
+        ranked = self._timed("result_cache", result_cache.get, key)
+        if ranked is not None:
+            logger.debug("Serving cached results")
+            return ranked
+
+        ranked = await self._rank(q, db)
+        # Fallback results are only a stand-in for a slow parse
+        if not self.fell_back:
+            result_cache.set(key, ranked)
+        return ranked
+
+    async def _catalog_version(self, db):
+        if self.catalog_version is None:
+            self.catalog_version = await catalog_version.current(db)
+        return self.catalog_version
+
+    async def _rank(self, q: str, db):
+        # Cached and local parses take microseconds, nothing to hide behind a probe
+        parsed = await self._timed_async("parse", self._parse(q, parse_query_without_llm))
+        if parsed is not None:
+            return await self._search_parsed(parsed, db)
+
+        if not SPECULATIVE_RETRIEVAL:
+            # Parse categories and relevant tags from query
+            parsed = await self._timed_async("parse", self._parse(q, parse_query_with_llm))
+            return await self._search_parsed(parsed, db)
+
+        parse_task = asyncio.create_task(
+            self._timed_async("parse", self._parse(q, parse_query_with_llm))
+        )
+        probe_query = self._format_query(self._add_user_preferences({"category": [q.lower().strip()]}))
+        speculative_task = asyncio.create_task(
+            self._timed_async(
+                "speculative_search",
+                self._with_session(
+                    partial(self._embed_and_search, stage_prefix="speculative_"),
+                    probe_query,
+                    None,
+                ),
+            )
+        )
+
+        try:
+            parsed = await asyncio.wait_for(parse_task, timeout=PARSE_TIMEOUT_SECONDS)
+        except Exception as e:
+            # Parse timed out or failed, serve the raw query probe instead
+            logger.warning("Falling back to speculative results: %r", e)
+            self.fell_back = True
+            speculative_products = await speculative_task
+            return self._timed(
+                "rerank",
+                self._rerank_products,
+                self._merge_results(speculative_products, []),
+            )
+
+        try:
+            # The probe is the parsed query's vector branch if both embed the same text
+            return await self._search_parsed(parsed, db, probe=(probe_query, speculative_task))
+        finally:
+            # A reused probe that the search didn't await (e.g. a semantic cache hit)
+            speculative_task.cancel()
+
+    async def _parse(self, q: str, parse=parse_query):
+        # The LLM client (and the local parser's first lexicon load) are
+        # blocking, so parsing runs on the thread pool
+        return await asyncio.get_running_loop().run_in_executor(retrieval_executor, parse, q)
+
+    async def _search_parsed(self, parsed, db, probe=None):
+        logger.debug("Parsed query %s", parsed)
         keywords_for_title_search = parsed.get("category", []) + parsed.get("tags", [])
 
-        query_with_preferences = self._add_user_preferences(parsed)
-        print("Query with preferences", query_with_preferences)
+        query_with_preferences = self._timed("preferences", self._add_user_preferences, parsed)
+        logger.debug("Query with preferences %s", query_with_preferences)
 
-        formatted_query = self._format_query(query_with_preferences)
-        print("Formatted query", formatted_query)
+        formatted_query = self._timed("format", self._format_query, query_with_preferences)
+        logger.debug("Formatted query %s", formatted_query)
 
-        ## TODO: Run both retrieval methods in parallel
-        
-        # Embeddings search
-        embedding = embed_text(formatted_query)[0]
-        retrieved_embeddings_products = self._embeddings_search(embedding, db)
-        print(f"Retrieved {len(retrieved_embeddings_products)} products from embeddings search")
+        logger.debug("Keywords for title search %s", keywords_for_title_search)
+        probe_task = None
+        if probe is not None:
+            if probe[0] == formatted_query and not HYBRID_RETRIEVAL:
+                logger.debug("Reusing the speculative probe as the embeddings search")
+                probe_task = probe[1]
+            else:
+                # Useless now, so return its connection before retrieval needs two more
+                probe[1].cancel()
+        embedding = None
+        semantic_scope = None
+        if SEMANTIC_CACHE_ENABLED and self.catalog_version is not None:
+            # Embedded up front to look for a near-duplicate query; the
+            # retrievers then get it from the embedding cache
+            embedding = await self._timed_async("embed", embed_query_async(formatted_query))
+            semantic_scope = semantic_cache_scope(
+                self.catalog_version,
+                self.rules.version,
+                self.search_profile,
+                self.user_preferences,
+            )
+            products = self._timed("semantic_cache", semantic_cache.get, semantic_scope, embedding)
+            if products is not None:
+                logger.debug("Serving results of a similar query")
+                return products
 
-        # Title search on keywords
-        print("Keywords for title search", keywords_for_title_search)
-        retrieved_title_products = self._title_search(keywords_for_title_search, db)
-        print(f"Retrieved {len(retrieved_title_products)} products from title search")
+        products = await self._retrieve_and_rank(
+            formatted_query, embedding, keywords_for_title_search, db, probe_task=probe_task
+        )
+        if semantic_scope is not None:
+            semantic_cache.set(semantic_scope, embedding, products)
+        return products
+
+    async def _retrieve_and_rank(self, formatted_query, embedding, keywords_for_title_search, db, probe_task=None):
+        if HYBRID_RETRIEVAL:
+            if embedding is None:
+                embedding = await self._timed_async("embed", embed_query_async(formatted_query))
+            merged_products = await self._timed_async(
+                "hybrid_search",
+                self._hybrid_search(embedding, keywords_for_title_search, db),
+            )
+            logger.debug("Retrieved %d candidates from hybrid search", len(merged_products))
+            products = self._timed("rerank", self._rerank_products, merged_products)
+            logger.debug("Reranked %d products", len(products))
+            return products
+
+        retrieved_embeddings_products, retrieved_title_products = await self._timed_async(
+            "retrieval",
+            self._retrieve(formatted_query, embedding, keywords_for_title_search, db, probe_task),
+        )
+        logger.debug("Retrieved %d candidates from embeddings search", len(retrieved_embeddings_products))
+        logger.debug("Retrieved %d candidates from title search", len(retrieved_title_products))
 
         # De-dupe and merge results
-        merged_products = self._merge_results(retrieved_embeddings_products, retrieved_title_products)
+        merged_products = self._timed(
+            "merge", self._merge_results, retrieved_embeddings_products, retrieved_title_products
+        )
+
+        products = self._timed("rerank", self._rerank_products, merged_products)
+        logger.debug("Reranked %d products", len(products))
+
+        return products
+
+    def server_timing(self) -> str:
+        """Formats the stage timings of the last search as a Server-Timing header."""
+        return ", ".join(
+            f"{stage};dur={duration:.1f}" for stage, duration in self.timings.items()
+        )
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[stage] = (time.perf_counter() - start) * 1000
+
+    async def _timed_async(self, stage, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[stage] = (time.perf_counter() - start) * 1000
+
+    async def _retrieve(self, formatted_query, embedding, keywords, db, probe_task=None):
+        if probe_task is not None:
+            embeddings_branch = probe_task
+        elif PARALLEL_RETRIEVAL:
+            embeddings_branch = self._with_session(self._embed_and_search, formatted_query, embedding)
+        else:
+            embeddings_branch = self._embed_and_search(formatted_query, embedding, db)
+
+        if not PARALLEL_RETRIEVAL:
+            return (
+                await self._timed_async("embeddings_search", embeddings_branch),
+                await self._timed_async("title_search", self._title_search(keywords, db)),
+            )
+
+        # Run both retrievers concurrently so latency is that of the slowest
+        # branch. A session can't run two queries at once, so each opens its own.
+        return await asyncio.gather(
+            self._timed_async("embeddings_search", embeddings_branch),
+            self._timed_async(
+                "title_search",
+                self._with_session(self._title_search, keywords),
+            ),
+        )
 
-        products = self._rerank_products(merged_products)
-        print(f"Reranked {len(products)} products")
+    async def _with_session(self, fn, *args):
+        async with AsyncSessionLocal() as db:
+            return await fn(*args, db)
 
+    async def _embed_and_search(self, formatted_query, embedding, db, stage_prefix=""):
+        # The speculative probe's stages are kept apart from the parsed query's
+        if embedding is None:
+            embedding = await self._timed_async(
+                f"{stage_prefix}embed", embed_query_async(formatted_query)
+            )
+        products = await self._timed_async(
+            f"{stage_prefix}embeddings_sql", self._embeddings_search(embedding, db)
+        )
+        if self.provisional is not None and not self.provisional.done():
+            self.provisional.set_result(products)
         return products
     
     def _add_user_preferences(self, parsed_query):
@@ -88,8 +754,8 @@ class SearchService:
                 return parsed_query
             else:
                 return parsed_query
-        except Exception as e:
-            print("Error adding user preferences", e)
+        except Exception:
+            logger.exception("Error adding user preferences")
             return parsed_query
     
     def _format_query(self, parsed):
@@ -117,39 +783,93 @@ class SearchService:
 
         return str(formatted_query)
 
-    def _embeddings_search(self, embedding, db):
-        command = text(
-            f"""
-            SELECT id, 1 - (embedding <=> '{embedding}') AS similarity, title, "imageUrls", average_rating, rating_number, store, "createdAt", "modifiedAt", "deletedAt", description FROM products
-            WHERE embedding IS NOT NULL AND "deletedAt" IS NULL
-            ORDER BY embedding <=> '{embedding}'
-            LIMIT 100;
-        """
-        )
-        result = db.execute(command).fetchall()
+    async def _apply_search_profile(self, db) -> bool:
+        """Sets ef_search for this transaction if needed, returns whether to scan exactly."""
+        ef_search = SEARCH_PROFILES[self.search_profile]["ef_search"]
+        if ef_search is None:
+            return True
+        connection = await db.connection()
+        if connection.info.get("hnsw.ef_search") != ef_search:
+            # Transaction scoped, so the connection's default is restored
+            await db.execute(set_ef_search, {"ef_search": str(ef_search)})
+        return False
+
+    async def _embeddings_search(self, embedding, db):
+        if await self._apply_search_profile(db):
+            command = exact_embeddings_search_query
+        else:
+            command = embeddings_search_query
+        result = (await db.execute(command, {"embedding": embedding})).fetchall()
 
-        retrieved_products = [ProductSchema.from_orm(row) for row in result]
+        retrieved_products = [Candidate(**row._mapping) for row in result]
         return retrieved_products
 
-    def _title_search(self, keywords: list[str], db):
+    async def _title_search(self, keywords: list[str], db):
         try:
             if len(keywords) == 0:
                 return []
-            keywords_match_str = " AND ".join([f"title ILIKE '%{keyword}%'" for keyword in keywords[:MAX_KEYWORDS]])
-            command = text(
-                f"""
-                SELECT id, 1 as similarity, title, "imageUrls", average_rating, rating_number, store, "createdAt", "modifiedAt", "deletedAt", description FROM products
-                WHERE {keywords_match_str} AND "deletedAt" IS NULL
-                LIMIT 100;
-            """
-            )
-            result = db.execute(command).fetchall()
-            retrieved_products = [ProductSchema.from_orm(row) for row in result]
+            keywords = keywords[:MAX_KEYWORDS]
+            params = {f"keyword_{i}": like_pattern(k) for i, k in enumerate(keywords)}
+            params["keywords"] = " ".join(keywords)
+            result = (await db.execute(title_search_queries[len(keywords)], params)).fetchall()
+            retrieved_products = [Candidate(**row._mapping) for row in result]
             return retrieved_products
-        except Exception as e:
-            print("Error in title search", e)
+        except Exception:
+            logger.exception("Error in title search")
+            # With PARALLEL_RETRIEVAL=false this is the request's session, and
+            # hydrate would fail on the aborted transaction
+            await db.rollback()
             return []
     
+    async def _hybrid_search(self, embedding, keywords: list[str], db):
+        keywords = keywords[:MAX_KEYWORDS]
+        params = {f"keyword_{i}": like_pattern(k) for i, k in enumerate(keywords)}
+        params.update(
+            embedding=embedding,
+            keywords=" ".join(keywords),
+            embeddings_weight=EMBEDDINGS_MATCH_WEIGHT,
+            title_weight=TITLE_MATCH_WEIGHT,
+            top_k=HYBRID_TOP_K,
+            rules_version=self.rules.version,
+        )
+        exact = await self._apply_search_profile(db)
+        result = (
+            await db.execute(hybrid_search_queries[(len(keywords), exact)], params)
+        ).fetchall()
+        return [Candidate(**row._mapping) for row in result]
+
+    async def _hydrate(self, candidates, db):
+        """Fetches full rows for ranked candidates in one query, keeping their order."""
+        return (await self._hydrate_pages([candidates], db))[0]
+
+    async def _hydrate_pages(self, pages, db):
+        # One query for the products of every page that aren't cached
+        version = await self._catalog_version(db)
+        id_to_row = {}
+        missing_ids = []
+        for product_id in {c.id for page in pages for c in page}:
+            row = product_cache.get((version, product_id)) if version is not None else None
+            if row is None:
+                missing_ids.append(product_id)
+            else:
+                id_to_row[product_id] = row
+
+        if missing_ids:
+            rows = (await db.execute(hydrate_products_query, {"ids": missing_ids})).fetchall()
+            for row in rows:
+                id_to_row[row.id] = dict(row._mapping)
+                if version is not None:
+                    product_cache.set((version, row.id), id_to_row[row.id])
+
+        return [
+            [
+                ProductSchema(**id_to_row[c.id], similarity=c.similarity)
+                for c in page
+                if c.id in id_to_row
+            ]
+            for page in pages
+        ]
+
     def _merge_results(self, embeddings_products, title_products):
         # Combine and add scores if they appear in both based on ID match
         id_to_score = defaultdict(float)
@@ -171,116 +891,33 @@ class SearchService:
         return merged_products
 
     def _rerank_products(self, products):
-        for product in products:
-            score = product.similarity
-
-            # Penalize if the photo is "no image avaialable"
-            if len(product.imageUrls) > 0 and product.imageUrls[0] == [
-                "https://m.media-amazon.com/images/I/01RmK+J4pJL._AC_.gif"
-            ]:
-                score += RERANKING_CONFIG["no_photo"]["weight"]
-
-            # Penalize if title marked for archive
-            if product.title and product.title == "Marked For Archive":
-                score += RERANKING_CONFIG["marked_for_archive"]["weight"]
-
-            # Rule 3: High average rating boost
-            avg_rating = product.average_rating if product.average_rating else 0
-            if avg_rating >= RERANKING_CONFIG["high_average_rating"]["threshold"]:
-                norm_rating = (
-                    avg_rating
-                    / RERANKING_CONFIG["high_average_rating"]["normalization_constant"]
-                )
-                score += norm_rating * RERANKING_CONFIG["high_average_rating"]["weight"]
-
-            # Rule 4: Low average rating penalty
-            if avg_rating < RERANKING_CONFIG["low_average_rating"]["threshold"]:
-                norm_rating = (
-                    avg_rating
-                    / RERANKING_CONFIG["low_average_rating"]["normalization_constant"]
-                )
-                score += norm_rating * RERANKING_CONFIG["low_average_rating"]["weight"]
-
-            # Rule 5: High ratings number boost
-            rating_number = product.rating_number if product.rating_number else 0
-            if rating_number > RERANKING_CONFIG["high_rating_number"]["threshold"]:
-                capped_count = min(
-                    rating_number, RERANKING_CONFIG["high_rating_number"]["ceiling"]
-                )
-                norm_count = (
-                    capped_count
-                    / RERANKING_CONFIG["high_rating_number"]["normalization_constant"]
-                )
-                score += norm_count * RERANKING_CONFIG["high_rating_number"]["weight"]
-
-            product.similarity = score
-
-        return sorted(products, key=lambda x: x.similarity, reverse=True)
+        return rerank(products, k=RERANK_TOP_K or None, rules=self.rules)
 
 
 if __name__ == "__main__":
+    # A rules reload must miss the result cache; no database needed
+    ranks = []
 
-    def test_rerank_products():
-        service = SearchService()
-
-        products = [
-            # Case 1: No photo penalty
-            {
-                "similarity": 1.0,
-                "rating_number": 0,
-                "average_rating": 3,
-                "title": "No Photo Item",
-                "image_urls": [
-                    "https://m.media-amazon.com/images/I/01RmK+J4pJL._AC_.gif"
-                ],
-            },
-            # Case 2: Title "Marked For Archive"
-            {
-                "similarity": 1.0,
-                "rating_number": 0,
-                "average_rating": 0,
-                "title": "Marked For Archive",
-                "image_urls": ["https://example.com/photo.jpg"],
-            },
-            # Case 3: High average rating boost
-            {
-                "similarity": 1.0,
-                "rating_number": 0,
-                "average_rating": 4.5,
-                "title": "Great Product",
-                "image_urls": ["https://example.com/photo.jpg"],
-            },
-            # Case 4: Low average rating penalty
-            {
-                "similarity": 1.0,
-                "rating_number": 0,
-                "average_rating": 1.5,
-                "title": "Bad Product",
-                "image_urls": ["https://example.com/photo.jpg"],
-            },
-            # Case 5: High ratings count boost
-            {
-                "similarity": 1.0,
-                "rating_number": 100,
-                "average_rating": 3.0,
-                "title": "Popular Product",
-                "image_urls": ["https://example.com/photo.jpg"],
-            },
-            # Case 6: All conditions combined
-            {
-                "similarity": 1.0,
-                "rating_number": 150,
-                "average_rating": 4.8,
-                "title": "Marked For Archive",
-                "image_urls": [
-                    "https://m.media-amazon.com/images/I/01RmK+J4pJL._AC_.gif"
-                ],
-            },
-        ]
-
-        ranked = service._rerank_products(products)
-
-        for p in ranked:
-            print(f"{p['title']} => similarity: {p['similarity']:.3f}")
+    async def check_rules_reload():
+        async def rank(q, db):
+            ranks.append(q)
+            return []
 
-    test_rerank_products()
+        for _ in range(2):
+            service = SearchService(None)
+            service.catalog_version = 1
+            service._rank = rank
+            await service._cached_rank("red dress", None)
+        assert len(ranks) == 1, ranks
+
+        reloaded = [dict(rule) for rule in DEFAULT_RERANKING_RULES]
+        reloaded[0]["weight"] = -0.25
+        rule_engine.rules = RuleSet(reloaded)
+        service = SearchService(None)
+        service.catalog_version = 1
+        service._rank = rank
+        await service._cached_rank("red dress", None)
+        assert len(ranks) == 2, ranks
+
+    asyncio.run(check_rules_reload())
+    print("Reloading the rules misses the result cache")
@@ -1,9 +1,11 @@
 import json
 import uuid
 from sqlalchemy.orm import Session
+from .catalog import bump_catalog_version
 from .database import SessionLocal
 from .models import Product
 from .clip_embedder import embed_text
+from .reranker import quality_score
 from dotenv import load_dotenv
 
 from transformers import AutoTokenizer, AutoModel
@@ -39,7 +41,14 @@ def load_products(db: Session):
             rating_number=item.get("rating_number"),
             store=item.get("main_category"),
         )
+        product.quality_score, product.quality_score_rules = quality_score(
+            item["title"],
+            image_urls,
+            item.get("average_rating"),
+            item.get("rating_number"),
+        )
         db.add(product)
+    bump_catalog_version(db)
     db.commit()
     print(f"Inserted {len(data)} products.")
 
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+# Reuse the ranking of a recent query whose formatted-query embedding is at least
+# this cosine similar, e.g. "black leather boots" and "leather boots in black".
+# Off by default: hits trade some relevance for skipping retrieval, measure the
+# threshold with app/scripts/replay_semantic_cache.py first.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "2048"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+
+
+class SemanticCache:
+    """Recent query embeddings in a flat in-memory index, looked up by cosine similarity.
+
+    Entries are only matched within the same scope (catalog version, profile and
+    preferences). The oldest entry is overwritten once the index is full.
+    """
+
+    def __init__(self, maxsize: int = 2048, threshold: float = 0.97, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._similarity_sum = 0.0
+        self._lock = threading.Lock()
+        # Allocated on the first set, once the embedding size is known
+        self._embeddings = None
+        self._scope_hashes = np.zeros(maxsize, dtype=np.int64)
+        self._expires_at = np.full(maxsize, -np.inf)
+        self._scopes = [None] * maxsize
+        self._values = [None] * maxsize
+        self._next = 0
+
+    def get(self, scope: Hashable, embedding, default: Any = None) -> Any:
+        """Returns the value of the most similar entry in scope over the threshold."""
+        query = self._normalize(embedding)
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != len(query):
+                self.misses += 1
+                return default
+            (slots,) = np.nonzero(
+                (self._scope_hashes == hash(scope)) & (self._expires_at >= time.monotonic())
+            )
+            best = None
+            if len(slots):
+                similarities = self._embeddings[slots] @ query
+                i = int(np.argmax(similarities))
+                if similarities[i] >= self.threshold and self._scopes[slots[i]] == scope:
+                    best = slots[i]
+            if best is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._similarity_sum += float(similarities[i])
+            return self._values[best]
+
+    def set(self, scope: Hashable, embedding, value: Any):
+        embedding = self._normalize(embedding)
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != len(embedding):
+                self._embeddings = np.zeros((self.maxsize, len(embedding)), dtype=np.float32)
+                self._expires_at[:] = -np.inf
+            slot = self._next
+            self._next = (slot + 1) % self.maxsize
+            self._embeddings[slot] = embedding
+            self._scope_hashes[slot] = hash(scope)
+            self._expires_at[slot] = time.monotonic() + self.ttl if self.ttl else np.inf
+            self._scopes[slot] = scope
+            self._values[slot] = value
+
+    def clear(self):
+        with self._lock:
+            self._expires_at[:] = -np.inf
+            self._scopes = [None] * self.maxsize
+            self._values = [None] * self.maxsize
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = int(np.count_nonzero(self._expires_at >= time.monotonic()))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": size,
+            "maxsize": self.maxsize,
+            "threshold": self.threshold,
+            "mean_hit_similarity": self._similarity_sum / self.hits if self.hits else None,
+        }
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+
+semantic_cache = SemanticCache(
+    maxsize=SEMANTIC_CACHE_SIZE,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl=SEMANTIC_CACHE_TTL_SECONDS,
+)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    cache = SemanticCache(maxsize=4, threshold=0.95)
+    boots = rng.normal(size=512)
+    cache.set(("v1", "women"), boots, "boots ranking")
+    near = boots + rng.normal(scale=0.05, size=512)
+    assert cache.get(("v1", "women"), near) == "boots ranking"
+    assert cache.get(("v1", "men"), near) is None
+    assert cache.get(("v2", "women"), near) is None
+    assert cache.get(("v1", "women"), rng.normal(size=512)) is None
+    # The oldest entry is overwritten once full
+    for i in range(4):
+        cache.set(("v1", "women"), rng.normal(size=512), i)
+    assert cache.get(("v1", "women"), boots) is None
+    print(cache.stats())